@@ -7,7 +7,7 @@ __author__ = 'Frank Wang'
 JSON API definition.
 '''
 
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64
 
 
 class Page(object):
@@ -61,6 +61,89 @@ class Page(object):
     __repr__ = __str__
 
 
+def encode_cursor(direction, key):
+    '''
+    Encode a keyset pagination cursor as an opaque url-safe string.
+
+    >>> decode_cursor(encode_cursor('next', (1500000000.5, 'abc')))
+    ('next', (1500000000.5, 'abc'))
+    '''
+    s = json.dumps([direction, list(key)], separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, keyset=None):
+    '''
+    Decode a cursor made by encode_cursor(), keyset (e.g. Model.__keyset__) checks the length of the key.
+
+    >>> decode_cursor(encode_cursor('next', (1, 2)), keyset=('created_at', 'id'))
+    ('next', (1, 2))
+    >>> decode_cursor(encode_cursor('next', (1,)), keyset=('created_at', 'id'))
+    Traceback (most recent call last):
+        ...
+    apis.APIValueError: Invalid cursor.
+    '''
+    try:
+        s = base64.urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode('ascii'))
+        c = json.loads(s.decode('utf-8'))
+        if not isinstance(c, list) or len(c) != 2:    # 形状不对的JSON，例如5
+            raise ValueError(cursor)
+        direction, key = c
+        if direction not in ('next', 'previous') or not isinstance(key, list):
+            raise ValueError(cursor)
+        if keyset is not None and len(key) != len(keyset):
+            raise ValueError(cursor)
+        if not all(isinstance(k, (str, int, float)) for k in key):    # 键的每一列都是标量，才能作为查询参数
+            raise ValueError(cursor)
+        return direction, tuple(key)
+    except ValueError:
+        raise APIValueError('cursor', 'Invalid cursor.')
+
+
+class CursorPage(object):
+    '''
+    Page object for keyset pagination, which carries opaque next/previous cursors instead of offsets.
+
+    >>> p = CursorPage(page_size=2)
+    >>> p.seek, p.limit
+    ({'after': None}, 3)
+    '''
+
+    def __init__(self, cursor=None, page_size=10, keyset=None):
+        self.page_size = page_size
+        self.limit = page_size + 1    # 多取一条，用来判断是否还有下一页(上一页)
+        self.direction, key = decode_cursor(cursor, keyset) if cursor else ('next', None)    # keyset是分页模型的__keyset__，用于校验游标
+        self.seek = dict(before=key) if self.direction == 'previous' else dict(after=key)    # 作为关键字参数传给findAll
+        self.has_next = False
+        self.has_previous = key is not None and self.direction == 'next'
+        self.next_cursor = None
+        self.previous_cursor = None
+
+    def paginate(self, items):
+        '''
+        Trim the fetched items to page_size and compute the next/previous cursors from their keyset().
+        '''
+        more = len(items) > self.page_size
+        if self.direction == 'previous':
+            items = items[-self.page_size:] if more else items    # 向前翻页时多出来的是最新的那一条
+            self.has_previous = more
+            self.has_next = True
+        else:
+            items = items[:self.page_size]
+            self.has_next = more
+        if items:
+            if self.has_next:
+                self.next_cursor = encode_cursor('next', items[-1].keyset())
+            if self.has_previous:
+                self.previous_cursor = encode_cursor('previous', items[0].keyset())
+        return items
+
+    def __str__(self):
+        return 'page_size: %s, has_next: %s, has_previous: %s, next_cursor: %s, previous_cursor: %s' % (self.page_size, self.has_next, self.has_previous, self.next_cursor, self.previous_cursor)
+
+    __repr__ = __str__
+
+
 class APIError(Exception):
     '''
     the base APIError which contains error(required), data(optional) and message(optional).
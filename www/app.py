@@ -18,7 +18,7 @@ from jinja2 import Environment, FileSystemLoader
 
 from config import configs
 
-import orm
+import orm, logs, ids
 from coroweb import add_routes, add_static
 
 from handlers import cookie2user, COOKIE_NAME
@@ -41,7 +41,7 @@ def init_jinja2(app, **kw):
     path = kw.get('path', None)
     if path is None:
         path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
-    logging.info('set jinja2 template path: %s' % path)
+    logging.info('set jinja2 template path: %s', path)
     env = Environment(loader=FileSystemLoader(path), **options)
     filters = kw.get('filters', None)    # A dict of filters for this environment. As long as no template was loaded it's safe to add new filters or remove old.
     if filters is not None:
@@ -50,28 +50,81 @@ def init_jinja2(app, **kw):
     app['__templating__'] = env    # 给Application添加一个env属性
 
 
+# 连接池耗尽时快速返回503，而不是让越来越多的协程排队等待连接；查询超过请求的截止时间时返回504
+async def overload_factory(app, handler):
+    async def overload(request):
+        try:
+            return await handler(request)
+        except orm.PoolExhaustedError as e:
+            logging.warning('service unavailable: %s', e)
+            return web.HTTPServiceUnavailable(headers={'Retry-After': '1'})
+        except orm.QueryTimeoutError as e:
+            logging.warning('query timeout: %s %s: %s', request.method, request.path, e)
+            return web.HTTPGatewayTimeout()
+    return overload
+
+
+# 每个请求的截止时间，请求中的所有查询共享，超时的查询在数据库中被终止并释放连接
+async def deadline_factory(app, handler):
+    async def deadline(request):
+        with orm.deadline(configs.request_timeout):
+            return await handler(request)
+    return deadline
+
+
+# 读自己的写：请求写过数据后，读主库的截止时间保存在cookie中，同一客户端(例如发表评论后刷新页面)
+# 在sticky_window内的后续请求都读主库，不会因为副本延迟读不到刚写的数据。
+# 这些请求不读模型的缓存，但缓存是每个进程各自的：由其他进程处理的、不带cookie的请求在缓存的ttl内仍可能读到旧数据
+STICKY_COOKIE = 'awesticky'
+
+async def sticky_factory(app, handler):
+    async def sticky(request):
+        try:
+            orm.read_primary_until(float(request.cookies.get(STICKY_COOKIE, 0)))
+        except ValueError:
+            pass
+        before = orm.primary_until()
+        r = await handler(request)
+        until = orm.primary_until()
+        if until > before and isinstance(r, web.StreamResponse):
+            r.set_cookie(STICKY_COOKIE, '%.3f' % until, max_age=int(until - time.time()) + 1, httponly=True)
+        return r
+    return sticky
+
+
+# 决定本次请求是否输出调试日志(调试模式下全部输出，否则按比例抽样)，日志只在需要输出时才格式化
 async def logger_factory(app, handler):
     async def parse_data(request):
-        if request.method == 'POST':
-            if request.content_type.startswith('application.json'):
-                request.__data__ = await request.json()
-                logging.info('request json: %s' % str(request.__data__))
-            elif request.content_type.startswith('application.x-www-form-urlencoded'):
-                request.__data__ = await request.post()
-                logging.info('request form: %s' % str(request.__data__))
-        return await handler(request)
+        token = logs.start_request()
+        try:
+            if logs.traced():
+                logs.request_log.debug('request: %s %s', request.method, request.path)
+            if request.method == 'POST':
+                if request.content_type.startswith('application.json'):
+                    request.__data__ = await request.json()
+                    if logs.traced():
+                        logs.request_log.debug('request json: %s', request.__data__)
+                elif request.content_type.startswith('application.x-www-form-urlencoded'):
+                    request.__data__ = await request.post()
+                    if logs.traced():
+                        logs.request_log.debug('request form: %s', request.__data__)
+            return await handler(request)
+        finally:
+            logs.end_request(token)
     return parse_data
 
 # 将浏览器中的cookie解析出来绑定在request上，此后用check_admin持续验证登录
 async def auth_factory(app, handler):
         async def auth(request):
-            logging.info('check user: %s %s' % (request.method, request.path))
+            if logs.traced():
+                logs.request_log.debug('check user: %s %s', request.method, request.path)
             request.__user__ = None
             cookie_str = request.cookies.get(COOKIE_NAME)
             if cookie_str:
                 user = await cookie2user(cookie_str)
                 if user:
-                    logging.info('set current user: %s' % user.email)
+                    if logs.traced():
+                        logs.request_log.debug('set current user: %s', user.email)
                     request.__user__ = user
             if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
                 return web.HTTPFound('/signin')
@@ -79,10 +132,17 @@ async def auth_factory(app, handler):
         return auth
 
 
+# json序列化：紧凑的行对象(orm.Row)通过to_dict()导出，其他对象(例如Page)使用__dict__
+def json_default(o):
+    to_dict = getattr(o, 'to_dict', None)
+    if to_dict is not None:
+        return to_dict()
+    return o.__dict__
+
+
 # 拦截器，将返回值转换成web.Response对象再返回
 async def response_factory(app, handler):
     async def response(request):
-        logging.info('Response handler...')
         r = await handler(request)
         if isinstance(r, web.StreamResponse):
             return r
@@ -99,7 +159,7 @@ async def response_factory(app, handler):
         if isinstance(r, dict):
             template = r.get('__template__')
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=json_default).encode('utf-8'))
                 resp.content_type = 'application/json;charset-utf-8'
                 return resp
             else:
@@ -138,17 +198,23 @@ def datetime_filter(t):
     return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
 
-async def init(loop):
+async def init(loop, host='127.0.0.1', port=9000):
+        ids.configure(configs.ids.worker_id, configs.ids.lock_dir)
         await orm.create_pool(loop=loop, **configs.db)
+        if configs.db.create_tables:    # 嵌入式的SQLite后端在启动时根据Model及其声明的索引建表
+            await orm.create_tables()
         app = web.Application(loop=loop, middlewares=[
-            logger_factory, auth_factory, response_factory
+            overload_factory, deadline_factory, logger_factory, sticky_factory, auth_factory, response_factory
         ])
-        init_jinja2(app, filters=dict(datetime=datetime_filter), path=r'E:\python_web\www\templates')
+        init_jinja2(app, filters=dict(datetime=datetime_filter))    # 默认使用本文件所在目录下的templates
         add_routes(app, 'handlers')
         add_static(app)
-        srv = await loop.create_server(app.make_handler(), '127.0.0.1', 9000)
-        logging.info('server started at http://127.0.0.1:9000...')
+        srv = await loop.create_server(app.make_handler(), host, port)
+        logging.info('server started at http://%s:%s...', host, port)
         return srv
-loop = asyncio.get_event_loop()
-loop.run_until_complete(init(loop))
-loop.run_forever()
+
+if __name__=='__main__':
+    logs.setup_logging(configs.debug, sample_rate=configs.logging.sample_rate)    # 生产环境(debug=False)只抽样输出请求的调试日志
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(init(loop))
+    loop.run_forever()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Storage backends of the ORM: MySQL through aiomysql, and an embedded SQLite stand-in
+through aiosqlite that needs no database server (for tests and benchmarks).
+'''
+
+__author__ = 'Frank Wang'
+
+import asyncio
+
+try:
+    import aiomysql
+except ImportError:    # 只使用SQLite后端时不需要安装aiomysql
+    aiomysql = None
+
+try:
+    import aiosqlite
+except ImportError:    # 只使用MySQL后端时不需要安装aiosqlite
+    aiosqlite = None
+
+
+# 数值列的默认值也写进表定义，与schema.sql一致；可调用的默认值(例如time.time)只能由orm填写
+def _default(default):
+    if isinstance(default, (int, float)) and not isinstance(default, bool):
+        return ' default %r' % default
+    return ''
+
+
+def _columns(columns):
+    return ', '.join(map(lambda c: '`%s`' % c, columns))
+
+
+class Backend(object):
+    '''
+    Interface between the ORM and a database driver.
+
+    A backend creates pools whose acquire()/release(conn) hand out connections with
+    begin()/commit()/rollback(), and it creates cursors with execute(sql, args),
+    fetchmany(size), fetchall() returning dicts, rowcount and close().
+    '''
+
+    name = None
+    placeholder = '%s'    # 驱动使用的参数占位符，ORM中的SQL统一使用?
+    explain = 'EXPLAIN'    # 查看执行计划的语句前缀
+
+    async def create_pool(self, loop, **kw):
+        raise NotImplementedError
+
+    def cursor(self, conn):
+        ' return an async context manager of a cursor that fetches rows as dicts. '
+        raise NotImplementedError
+
+    async def stream_cursor(self, conn):
+        ' return an unbuffered cursor for orm.stream(). '
+        raise NotImplementedError
+
+    async def discard_stream(self, conn, cur):
+        ' clean up a stream the consumer stopped reading before the end. '
+        raise NotImplementedError
+
+    def create_table_sql(self, model, table=None):
+        ' return the DDL statements that create the table of model (named table if given) with its declared indexes. '
+        columns = ['`%s` %s not null%s' % (f, model.__mappings__[f].column_type, _default(model.__mappings__[f].default)) for f in [model.__primary_key__] + model.__fields__]
+        columns.append('primary key (`%s`)' % model.__primary_key__)
+        return ['create table if not exists `%s` (%s)' % (table or model.__table__, ', '.join(columns))]
+
+    def rename_tables_sql(self, pairs):
+        return ['alter table `%s` rename to `%s`' % (old, new) for old, new in pairs]
+
+    async def table_indexes(self, conn, table):
+        ' return the secondary indexes that exist on table: {name: ([columns], unique)}. '
+        raise NotImplementedError
+
+    def add_index_sql(self, table, name, columns, unique):
+        ' return the DDL that adds an index to an existing table without blocking writes. '
+        raise NotImplementedError
+
+    async def cancel_query(self, conn):
+        ' stop the statement running on conn from another connection or thread. '
+        raise NotImplementedError
+
+    async def discard_connection(self, conn):
+        ' close conn so that the pool drops it instead of handing it out again. '
+        raise NotImplementedError
+
+
+class MySQLBackend(Backend):
+
+    name = 'mysql'
+    placeholder = '%s'
+
+    def __init__(self):
+        self._servers = dict()    # (host, port) -> 连接参数，用于建立执行KILL QUERY的单独连接
+
+    async def create_pool(self, loop, **kw):
+        if aiomysql is None:
+            raise RuntimeError('aiomysql is required by the mysql backend.')
+        host = kw.get('host', 'localhost')
+        port = kw.get('port', 3306)
+        self._servers[(host, port)] = dict(host=host, port=port, user=kw['user'], password=kw['password'],
+                                           connect_timeout=kw.get('connect_timeout', 10))
+        return await aiomysql.create_pool(    # create_pool(minsize=1, maxsize=10, loop=None, **kwargs)  A coroutine that create a pool of connection to MySQL database.
+            host=host,
+            port=port,
+            user=kw['user'],
+            password=kw['password'],
+            db=kw['db'],
+            charset=kw.get('charset','utf8'),
+            autocommit=kw.get('autocommit', True),
+            minsize=kw.get('minsize',1),    # aiomysql在创建连接池时就会建立minsize个连接(预热)
+            maxsize=kw.get('maxsize',10),
+            pool_recycle=kw.get('pool_recycle', -1),    # 连接使用超过pool_recycle秒后重建，-1表示不重建
+            connect_timeout=kw.get('connect_timeout', 10),
+            loop=loop
+        )
+
+    def cursor(self, conn):
+        return conn.cursor(aiomysql.DictCursor)
+
+    async def stream_cursor(self, conn):
+        return await conn.cursor(aiomysql.SSDictCursor)
+
+    async def discard_stream(self, conn, cur):
+        conn.close()    # 服务端还有未读完的结果，直接关闭连接让连接池丢弃它，而不是把剩余结果全部读完
+
+    async def cancel_query(self, conn):
+        killer = await aiomysql.connect(**self._servers[(conn.host, conn.port)])    # 不从连接池获取，连接池耗尽时也能终止查询
+        try:
+            async with killer.cursor() as cur:
+                await cur.execute('KILL QUERY %d' % conn.thread_id())    # 只终止语句，连接仍然可用
+        finally:
+            killer.close()
+
+    async def discard_connection(self, conn):
+        conn.close()
+
+    def create_table_sql(self, model, table=None):
+        sql = super().create_table_sql(model, table)
+        sql[0] = sql[0][:-1] + ''.join(', %skey `%s` (%s)' % ('unique ' if u else '', n, _columns(cs)) for n, cs, u in model.__indexes__) + ') engine=innodb default charset=utf8'
+        return sql
+
+    def rename_tables_sql(self, pairs):
+        return ['rename table %s' % ', '.join('`%s` to `%s`' % (old, new) for old, new in pairs)]    # 一条语句原子地完成所有改名
+
+    async def table_indexes(self, conn, table):
+        async with self.cursor(conn) as cur:
+            await cur.execute('select index_name as name, column_name as col, non_unique from information_schema.statistics '
+                              'where table_schema=database() and table_name=%s order by index_name, seq_in_index', (table,))
+            rs = await cur.fetchall()
+        indexes = dict()
+        for r in rs:
+            if r['name'] == 'PRIMARY':
+                continue
+            indexes.setdefault(r['name'], ([], not r['non_unique']))[0].append(r['col'])
+        return indexes
+
+    def add_index_sql(self, table, name, columns, unique):
+        return 'alter table `%s` add %sindex `%s` (%s), algorithm=inplace, lock=none' % (table, 'unique ' if unique else '', name, _columns(columns))    # 在线DDL，建索引期间不锁表
+
+
+class SQLiteCursor(object):
+    '''
+    Cursor over an aiosqlite connection that fetches rows as dicts, like aiomysql.DictCursor.
+    '''
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._cur = None
+        self.rowcount = -1
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def execute(self, sql, args=()):
+        self._cur = await self._conn.db.execute(sql, tuple(args or ()))
+        self.rowcount = self._cur.rowcount
+
+    def _dicts(self, rows):
+        names = [d[0] for d in self._cur.description]
+        return [dict(zip(names, r)) for r in rows]
+
+    async def fetchmany(self, size):
+        return self._dicts(await self._cur.fetchmany(size))
+
+    async def fetchall(self):
+        return self._dicts(await self._cur.fetchall())
+
+    async def close(self):
+        if self._cur is not None:
+            await self._cur.close()
+            self._cur = None
+
+
+class SQLiteConnection(object):
+
+    def __init__(self, db):
+        self.db = db
+        self.closed = False
+
+    async def begin(self):
+        await self.db.execute('begin')
+
+    async def commit(self):
+        await self.db.execute('commit')
+
+    async def rollback(self):
+        await self.db.execute('rollback')
+
+    async def close(self):
+        self.closed = True
+        await self.db.close()
+
+
+class SQLitePool(object):
+    '''
+    A minimal connection pool with the interface of aiomysql.Pool used by the ORM.
+    '''
+
+    def __init__(self, path, minsize=1, maxsize=10):
+        if path == ':memory:':    # 内存数据库的每个连接都是独立的数据库，只能使用一个连接
+            minsize = maxsize = 1
+        self.path = path
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self._size = 0
+        self._free = []
+        self._sem = asyncio.Semaphore(maxsize)
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    async def _connect(self):
+        db = await aiosqlite.connect(self.path, isolation_level=None)    # 与aiomysql的autocommit=True一致，事务由begin()显式开始
+        if self.path != ':memory:':
+            await db.execute('pragma journal_mode=wal')    # 读写不互相阻塞
+            await db.execute('pragma busy_timeout=5000')
+        self._size += 1
+        return SQLiteConnection(db)
+
+    async def fill(self):
+        while self._size < self.minsize:
+            self._free.append(await self._connect())
+
+    async def acquire(self):
+        await self._sem.acquire()
+        try:
+            if self._free:
+                return self._free.pop()
+            return await self._connect()
+        except BaseException:
+            self._sem.release()
+            raise
+
+    def release(self, conn):
+        if conn.closed:
+            self._size -= 1
+        else:
+            self._free.append(conn)
+        self._sem.release()
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        while self._free:
+            await self._free.pop().close()
+            self._size -= 1
+
+
+class SQLiteBackend(Backend):
+
+    name = 'sqlite'
+    placeholder = '?'
+    explain = 'EXPLAIN QUERY PLAN'
+
+    async def create_pool(self, loop, **kw):
+        if aiosqlite is None:
+            raise RuntimeError('aiosqlite is required by the sqlite backend.')
+        pool = SQLitePool(kw.get('path', ':memory:'), minsize=kw.get('minsize', 1), maxsize=kw.get('maxsize', 10))
+        await pool.fill()    # 与aiomysql一样预先建立minsize个连接
+        return pool
+
+    def cursor(self, conn):
+        return SQLiteCursor(conn)
+
+    async def stream_cursor(self, conn):
+        return SQLiteCursor(conn)    # SQLite的游标本来就是逐行读取的
+
+    async def discard_stream(self, conn, cur):
+        if cur is not None:
+            await cur.close()
+
+    async def cancel_query(self, conn):
+        await conn.db.interrupt()    # 在事件循环线程中直接调用，不需要等待正在执行查询的工作线程
+
+    async def discard_connection(self, conn):
+        conn.closed = True    # 连接池不再使用它
+        asyncio.ensure_future(conn.db.close())    # 工作线程执行完当前语句后再关闭
+
+    def create_table_sql(self, model, table=None):
+        sql = super().create_table_sql(model, table)
+        for name, columns, unique in model.__indexes__:
+            sql.append(self.add_index_sql(table or model.__table__, name, columns, unique))
+        return sql
+
+    async def table_indexes(self, conn, table):
+        prefix = '%s_' % table
+        indexes = dict()
+        async with self.cursor(conn) as cur:
+            await cur.execute('pragma index_list(`%s`)' % table)
+            for r in await cur.fetchall():
+                if r['origin'] != 'c':    # 跳过主键和唯一约束自动创建的索引
+                    continue
+                name = r['name'][len(prefix):] if r['name'].startswith(prefix) else r['name']
+                await cur.execute('pragma index_info(`%s`)' % r['name'])
+                indexes[name] = ([c['name'] for c in sorted(await cur.fetchall(), key=lambda c: c['seqno'])], bool(r['unique']))
+        return indexes
+
+    def add_index_sql(self, table, name, columns, unique):    # SQLite的索引名在整个数据库中唯一，加上表名前缀
+        return 'create %sindex if not exists `%s_%s` on `%s` (%s)' % ('unique ' if unique else '', table, name, table, _columns(columns))
+
+
+_backends = dict(mysql=MySQLBackend, sqlite=SQLiteBackend)
+
+
+def get_backend(name):
+    try:
+        return _backends[name]()
+    except KeyError:
+        raise ValueError('Unknown database backend: %s' % name)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Throughput and latency benchmark of the whole request path (middlewares, handlers, ORM),
+booted against the embedded SQLite backend so that no MySQL server is needed.
+
+    python3 bench_app.py [--blogs 200] [--comments 20000] [--concurrency 50] [--seconds 10]
+'''
+
+__author__ = 'Frank Wang'
+
+import argparse, asyncio, logging, os, tempfile, time
+
+import aiohttp
+
+import app, logs, orm
+from config import configs
+from models import User, Blog, Comment
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+async def seed(blogs, comments):
+    user = User(name='bench', email='bench@example.com', passwd='0' * 40, image='about:blank', admin=True)
+    await user.save()
+    bs = [Blog(user_id=user.id, user_name=user.name, user_image=user.image, name='blog %s' % i,
+               summary='summary %s' % i, content='content %s\n' % i * 200) for i in range(blogs)]
+    await Blog.save_many(bs)
+    await Comment.save_many([Comment(blog_id=bs[i % blogs].id, user_id=user.id, user_name=user.name,
+                                     user_image=user.image, content='comment %s' % i) for i in range(comments)], batch_size=500)
+    return bs
+
+
+async def load(url, session, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        async with session.get(url) as resp:
+            await resp.read()
+            if resp.status != 200:
+                errors.append(resp.status)
+        latencies.append(time.perf_counter() - start)
+
+
+async def run(loop, args):
+    srv = None
+    try:
+        srv = await app.init(loop, port=args.port)
+        await measure(args)
+    finally:    # aiosqlite的线程不是守护线程，不关闭连接池进程就不会退出
+        if srv is not None:
+            srv.close()
+            await srv.wait_closed()
+        await orm.close_pool()
+
+
+async def measure(args):
+    blogs = await seed(args.blogs, args.comments)
+    base = 'http://127.0.0.1:%s' % args.port
+    paths = ['/', '/api/blogs?page=3', '/api/blogs?cursor=', '/api/comments?page=50', '/api/comments?cursor=', '/blog/%s' % blogs[0].id]
+    print('%-28s %10s %10s %10s %10s %8s' % ('path', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency)) as session:
+        for path in paths:
+            latencies, errors = [], []
+            start = time.perf_counter()
+            deadline = start + args.seconds
+            await asyncio.gather(*[load(base + path, session, deadline, latencies, errors) for i in range(args.concurrency)])
+            elapsed = time.perf_counter() - start
+            print('%-28s %10.1f %10.2f %10.2f %10.2f %8d' % (path[:28], len(latencies) / elapsed, percentile(latencies, 50) * 1000,
+                  percentile(latencies, 95) * 1000, percentile(latencies, 99) * 1000, len(errors)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the request path against SQLite.')
+    parser.add_argument('--blogs', type=int, default=200)
+    parser.add_argument('--comments', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--port', type=int, default=9100)
+    args = parser.parse_args()
+    logs.setup_logging(False, sample_rate=0.0, level=logging.WARNING)    # 不让日志输出影响测量结果
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')    # 每次都从空数据库开始，结果可以复现
+    configs.db.backend = 'sqlite'
+    configs.db.path = path
+    configs.db.create_tables = True
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(loop, args))
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Compares the legacy 50-character string ids with the time-ordered integer ids of ids.py:
+insert throughput of comments (primary key plus the blog_id index) and the resulting
+database size, using the standard library sqlite3 module.
+
+    python3 bench_ids.py [--blogs 1000] [--comments 200000]
+'''
+
+__author__ = 'Frank Wang'
+
+import argparse, os, random, sqlite3, tempfile, time
+
+import ids
+
+SCHEMA = '''
+create table comments (
+    id %(type)s primary key not null,
+    blog_id %(type)s not null,
+    content text not null,
+    created_at real not null
+);
+create index comments_idx_blog_id_created_at on comments (blog_id, created_at);
+'''
+
+
+def run(name, column_type, new_id, args):
+    path = os.path.join(tempfile.mkdtemp(), '%s.db' % name)
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA % dict(type=column_type))
+    blogs = [new_id() for i in range(args.blogs)]
+    start = time.perf_counter()
+    for n in range(0, args.comments, args.batch_size):
+        rows = [(new_id(), random.choice(blogs), 'comment', time.time()) for i in range(min(args.batch_size, args.comments - n))]
+        db.executemany('insert into comments values (?, ?, ?, ?)', rows)
+        db.commit()
+    elapsed = time.perf_counter() - start
+    pages, page_size = db.execute('pragma page_count').fetchone()[0], db.execute('pragma page_size').fetchone()[0]
+    db.close()
+    print('%-10s %12.0f %12.2f' % (name, args.comments / elapsed, pages * page_size / 1024.0 / 1024.0))
+    os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark string ids against integer ids.')
+    parser.add_argument('--blogs', type=int, default=1000)
+    parser.add_argument('--comments', type=int, default=200000)
+    parser.add_argument('--batch-size', type=int, default=100)
+    args = parser.parse_args()
+    print('%-10s %12s %12s' % ('ids', 'inserts/s', 'size MB'))
+    run('legacy', 'varchar(50)', ids.legacy_id, args)
+    run('snowflake', 'bigint', ids.Snowflake(0).next_id, args)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Benchmark the cost of building a query with Model.query() (compiled once per shape and then
+looked up) against joining the SQL fragments the way findAll() does. No database is needed.
+
+    python3 bench_query.py [number]
+'''
+
+__author__ = 'Frank Wang'
+
+import sys, timeit
+
+from models import Blog
+
+
+def build_query():
+    return Blog.query().where(user_id='u', created_at__gte=1.0).order_by('-created_at').limit(10)._plan(False)
+
+
+def build_fragments():
+    sql = [Blog.__select_list__, 'where', 'user_id=? and created_at>=?', 'order by', 'created_at desc', 'limit', '?']
+    return ' '.join(sql), ['u', 1.0, 10]
+
+
+def main(n):
+    for label, build in (('Query', build_query), ('findAll fragments', build_fragments)):
+        t = min(timeit.repeat(build, number=n, repeat=5)) / n
+        print('%-20s %8.2f us/query' % (label, t * 1e6))
+    print('compiled shapes: %s' % len(Blog.__plans__))
+
+if __name__=='__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Benchmark memory and attribute access of Model instances against the compact rows (orm.Row)
+returned by findAll(..., compact=True). No database is needed: rows are built from dicts
+shaped like the ones DictCursor returns.
+
+    python3 bench_rows.py [rows]
+'''
+
+__author__ = 'Frank Wang'
+
+import sys, time, timeit, tracemalloc
+
+from models import Comment, next_id
+
+def make_records(n):
+    return [dict(id=next_id(), blog_id=next_id(), user_id=next_id(), user_name='user%s' % i,
+                 user_image='about:blank', content='comment %s' % i, created_at=time.time()) for i in range(n)]
+
+def measure(build, records):
+    tracemalloc.start()
+    start = time.perf_counter()
+    objs = build(records)
+    elapsed = time.perf_counter() - start
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return objs, size, elapsed
+
+def main(n):
+    records = make_records(n)
+    models, model_size, model_time = measure(lambda rs: [Comment(**r) for r in rs], records)
+    rows, row_size, row_time = measure(lambda rs: [Comment.__row__.from_dict(r) for r in rs], records)
+    print('%s comments' % n)
+    print('  %-22s %10s %12s %12s' % ('', 'bytes/row', 'build us/row', 'attr ns/op'))
+    m, r = models[0], rows[0]
+    for label, obj, size, t in (('Model (dict)', m, model_size, model_time), ('Row (__slots__)', r, row_size, row_time)):
+        attr = min(timeit.repeat(lambda: obj.user_name, number=100000, repeat=5)) / 100000
+        print('  %-22s %10d %12.2f %12.1f' % (label, size / n, t / n * 1e6, attr * 1e9))
+    del m['user_image']    # getValue()对缺失的属性：以前经过getattr -> __getattr__ -> KeyError，现在是dict.get
+    missing = min(timeit.repeat(lambda: m.getValue('user_image'), number=100000, repeat=5)) / 100000
+    getattr_missing = min(timeit.repeat(lambda: getattr(m, 'user_image', None), number=100000, repeat=5)) / 100000
+    print('  missing attribute: getValue %.1f ns/op, getattr via KeyError %.1f ns/op' % (missing * 1e9, getattr_missing * 1e9))
+    print('  memory saved: %.0f%%' % (100.0 * (model_size - row_size) / model_size))
+
+if __name__=='__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+In-process caches used by the ORM.
+'''
+
+__author__ = 'Frank Wang'
+
+import time
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''
+    Size-bounded LRU cache whose entries expire after ttl seconds.
+
+    >>> c = LRUCache(maxsize=2, ttl=60)
+    >>> c.set('a', 1); c.set('b', 2); c.get('a')
+    1
+    >>> c.set('c', 3)
+    >>> c.get('b') is None
+    True
+    >>> c.stats()['evictions']
+    1
+    '''
+
+    def __init__(self, maxsize=1000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = 0    # 每次失效都会递增，用于丢弃失效前开始的查询结果
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        value, expires = entry
+        if expires < time.monotonic():    # 已过期
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:    # 淘汰最久未使用的条目
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key):
+        self.version += 1
+        self._data.pop(key, None)
+
+    def clear(self):
+        self.version += 1
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(size=len(self._data), maxsize=self.maxsize, hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, hit_ratio=self.hits / total if total else 0.0)
+
+class RowCounter(object):
+    '''
+    Maintained row counts of one table, keyed by None for the whole table or by (column, value)
+    for a filtered count. Counts are adjusted by writes and reloaded once older than ttl seconds.
+
+    >>> c = RowCounter(ttl=60)
+    >>> c.set(None, 10); c.add(None, 1); c.get(None)
+    11
+    >>> c.add(('blog_id', 'b1'), 1); c.get(('blog_id', 'b1')) is None
+    True
+    '''
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.version = 0    # 每次写操作都会递增，用于丢弃与写操作并发的count查询结果
+        self._counts = dict()
+
+    def get(self, key):
+        entry = self._counts.get(key)
+        if entry is None or entry[1] < time.monotonic():    # 不存在或需要与真实count对账
+            return None
+        return entry[0]
+
+    def set(self, key, count):
+        self._counts[key] = [count, time.monotonic() + self.ttl]
+
+    def add(self, key, delta):
+        self.version += 1
+        entry = self._counts.get(key)
+        if entry is not None:    # 尚未加载的计数不需要维护，下次读取时会重新count
+            entry[0] = max(entry[0] + delta, 0)
+
+    def pop(self, key):
+        self.version += 1
+        self._counts.pop(key, None)
+
+    def clear(self):
+        self.version += 1
+        self._counts.clear()
+
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -9,12 +9,33 @@ __author__ = 'Frank Wang'
 
 configs = {
     'debug': True,
+    'request_timeout': 10.0,    # 每个请求中数据库操作(包括等待连接)的截止时间(秒)
     'db': {
+        'backend': 'mysql',    # mysql或sqlite，sqlite是嵌入式的替代品，用于在没有MySQL的机器上测试和性能测试
+        'path': 'awesome.db',    # sqlite数据库文件
+        'create_tables': False,    # 启动时根据Model建表，sqlite使用
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'www-data',
         'password': 'www-data',
-        'db': 'awesome'
+        'db': 'awesome',
+        'minsize': 1,
+        'maxsize': 10,
+        'pool_recycle': 3600,
+        'acquire_timeout': 1.0,
+        'max_waiters': 100,
+        'replicas': [],
+        'sticky_window': 5,    # 写操作之后多少秒内同一客户端的读走主库；模型的缓存是每个进程各自的，多进程部署时其他进程的缓存最多在ttl秒内仍是旧数据
+        'coalesce_reads': True,    # 同时执行的相同查询只访问一次数据库
+        'slow_query': 0.1,    # 超过0.1秒的语句记录到慢查询日志
+        'slow_log': 'slow_query.log'    # 按大小轮转的JSON慢查询日志，为空时输出到普通日志
+    },
+    'ids': {
+        'worker_id': None,    # 生成博客和评论id的进程编号(0-31)，所有主机上的进程都不能相同；None表示在本机的lock_dir中租用一个空闲的编号，只适用于单台主机
+        'lock_dir': None    # 租用编号的锁文件目录，None表示临时目录下的awesome-ids
+    },
+    'logging': {
+        'sample_rate': 0.01    # 非调试模式下输出调试日志的请求比例
     },
     'session': {
         'secret': 'Awesome'
@@ -8,8 +8,8 @@ import inspect
 from aiohttp import web
 from urllib import parse
 import logging
-import asyncio
 from apis import APIError
+import logs
 
 __author__ = 'Frank Wang'
 
@@ -75,7 +75,7 @@ def has_request_arg(fn):
     sig = inspect.signature(fn)
     params = sig.parameters
     found = False
-    logging.info(params)
+    logging.debug('params of %s: %s', fn.__name__, params)
     for name, param in params.items():
         if name == 'request':
             found = True
@@ -130,7 +130,9 @@ class RequestHandler(object):
         # request is one object or class of aiohttp.web, it has these functions
         # request would be passed in add_route()
         kw = None
-        logging.info(str(request))
+        traced = logs.traced()    # 只有被抽样的请求才格式化调试日志
+        if traced:
+            logs.request_log.debug('handle %s', request)
         if(self._has_var_kw_arg or self._has_named_kw_arg
                or self. _get_required_kw_args):    # 存在可变关键字参数，或者命名关键字参数或者无默认值的命名关键字参数
             if request.method == 'POST':
@@ -187,19 +189,20 @@ class RequestHandler(object):
                 kw = copy
             for k, v in request.match_info.items():
                 if k in kw:
-                    logging.warning('Duplicate arg name in named'
-                                    'arg and kw args: {0}'.format(k))
+                    logging.warning('Duplicate arg name in named arg and kw args: %s', k)
                 kw[k] = v
-        logging.info('has request? {0}'.format(str(self._has_request_arg)))
         if self._has_request_arg:    # 若有request参数且为最后一个参数
             kw['request'] = request
         if self._get_required_kw_args:    # 若存在无默认值的命名关键字参数
             for name in self._get_required_kw_args:
                 if name not in kw:
                     return web.HTTPBadRequest(text='Missing argument {0}'.format(name))
-        logging.info('call with args: {0}'.format(str(kw)))
+        if traced:
+            logs.request_log.debug('call %s with args: %s', self._func.__name__, kw)
         try:
-            r = await self._func(**kw)    # 调用URL处理函数，对解析出来的request进行处理
+            r = self._func(**kw)    # 调用URL处理函数，对解析出来的request进行处理
+            if inspect.isawaitable(r):    # 处理函数可以是普通函数，也可以是协程(asyncio.coroutine在Python 3.11中已被移除)
+                r = await r
             return r
         except APIError as e:
             return dict(error=e.error, data=e.data, message=e.message)
@@ -210,22 +213,22 @@ def add_static(app):
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
     app.router.add_static('/static/', path)
     # app is one object within aiohttp module
-    logging.info('add static {0} => {1}'.format('/static/', path))
+    logging.info('add static %s => %s', '/static/', path)
 
 
 def add_route(app, fn):
     # one simple URL handler function
-    logging.info('start add route')
     method = getattr(fn, '__method__', None)
     path = getattr(fn, '__route__', None)
     if path is None or method is None:
         raise ValueError('@get or @post not defined in {0}'.format(str(fn)))
-    if not asyncio.iscoroutine(fn) and not inspect.isgeneratorfunction(fn):
-        fn = asyncio.coroutine(fn)    # 检查fn是否为协程或生成器，如果不是，转化为生成器
-    logging.info('add route {0} {1} => {2} ({3})'.format(
-        method, path, fn.__name__,
-        ','.join(inspect.signature(fn).parameters.keys())))
-    app.router.add_route(method, path, RequestHandler(app, fn))    # 核心部分，将URL处理函数注册到app中真正URL处理函数并不是fn，而是实例化之后的RequestHandler
+    logging.info('add route %s %s => %s (%s)', method, path, fn.__name__,
+                 ','.join(inspect.signature(fn).parameters.keys()))
+    handler = RequestHandler(app, fn)
+
+    async def route(request):    # aiohttp只把async def的函数当作协程处理函数，其他可调用对象的返回值必须是Response
+        return await handler(request)
+    app.router.add_route(method, path, route)    # 核心部分，将URL处理函数注册到app中真正URL处理函数并不是fn，而是实例化之后的RequestHandler
 
 
 # 批量注册URL处理函数，从模块导入
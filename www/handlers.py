@@ -13,8 +13,9 @@ from apis import APIPermissionError, APIError
 from aiohttp import web
 
 from coroweb import get, post
-from apis import Page, APIValueError, APIResourceNotFoundError
+from apis import Page, CursorPage, APIValueError, APIResourceNotFoundError
 
+import orm
 from models import User, Comment, Blog, next_id
 from config import configs
 
@@ -72,6 +73,8 @@ async def cookie2user(cookie_str):
             return None
         user.passwd = '******'
         return user
+    except (orm.PoolExhaustedError, orm.QueryTimeoutError):
+        raise    # 连接池耗尽或查询超时不是无效的cookie，交给中间件返回503/504
     except Exception as e:
         logging.exception(e)
         return None
@@ -79,14 +82,22 @@ async def cookie2user(cookie_str):
 
 # 首页显示
 @get('/')
-async def index(*, page='1'):
+async def index(*, page='1', cursor=None):
+    if cursor is not None:    # 按游标翻页
+        page = CursorPage(cursor, keyset=Blog.__keyset__)
+        blogs = page.paginate(await Blog.findAll(limit=page.limit, **page.seek))
+        return {
+            '__template__': 'blogs.html',
+            'page': page,
+            'blogs': blogs
+        }
     page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')    # 返回博文总数，通过博文id返回博文总数
-    page = Page(num)    # 根据博文总数生成一个page对象
+    num = await Blog.count()    # 返回博文总数，使用ORM维护的计数而不是每次count(id)
+    page = Page(num, page_index)    # 根据博文总数生成一个page对象
     if num == 0:
         blogs = []
     else:
-        blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))    # 找出对应页数的所有博文，具体请查看select语句order by desc和limit关键字
+        blogs = await Blog.query().order_by('-created_at').limit(page.limit).offset(page.offset).all()    # 找出对应页数的所有博文，具体请查看select语句order by desc和limit关键字
     return {
         '__template__': 'blogs.html',
         'page': page,
@@ -94,21 +105,51 @@ async def index(*, page='1'):
     }
 
 
-# 根据博客id获取查看博客全文
+# 博客和评论中保存的作者名字和头像是发表时的副本，用户修改资料后就过时了，显示时用prefetch加载的用户覆盖
+def show_current_author(objs):
+    for o in objs:
+        if o.user is not None:
+            o.user_name = o.user.name
+            o.user_image = o.user.image
+
+
+# 博客页面每次显示的评论数
+COMMENTS_PAGE_SIZE = 20
+
+
+# 按created_at倒序取一页评论(键集分页)，页面的开销与博客的评论总数无关
+async def blog_comments_page(blog_id, cursor=None):
+    p = CursorPage(cursor, page_size=COMMENTS_PAGE_SIZE, keyset=Comment.__keyset__)
+    comments = p.paginate(await Comment.findAll('blog_id=?', [blog_id], limit=p.limit, prefetch=['user'], **p.seek))    # comment的id是附在blog上的
+    show_current_author(comments)
+    for c in comments:
+        c.html_content = text2html(c.content)    # 将comment的content转化为html附着在comment的属性上
+    return p, comments
+
+
+# 根据博客id获取查看博客全文，只渲染第一页评论，其余的由页面通过/api/blogs/{id}/comments加载
 @get('/blog/{id}')
 async def get_blog(id):
     blog = await Blog.find(id)
-    comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')    # comment的id是附在blog上的
-    for c in comments:
-        c.html_content = text2html(c.content)    # 将comment的content转化为html附着在comment的属性上
+    await Blog.prefetch([blog], 'user')
+    show_current_author([blog])
+    page, comments = await blog_comments_page(blog.id)
     blog.html_content = markdown2.markdown(blog.content)
     return {
         '__template__': 'blog.html',
         'blog': blog,
-        'comments': comments
+        'comments': comments,
+        'page': page
     }
 
 
+# 博客的评论，按时间倒序分页，cursor为上一页返回的page.next_cursor
+@get('/api/blogs/{id}/comments')
+async def api_blog_comments(id, *, cursor=None):
+    page, comments = await blog_comments_page(id, cursor)
+    return dict(page=page, comments=comments)
+
+
 # 根据id获取博文数据?
 @get('/api/blogs/{id}')
 async def api_get_blog(*, id):
@@ -136,7 +177,7 @@ async def api_register_user(*, email, name, passwd):
         raise APIValueError('email')
     if not passwd or not _RE_SHA1.match(passwd):
         raise APIValueError('passwd')
-    users = await User.findAll('email=?', [email])
+    users = await User.query().where(email=email).all()
     if len(users) > 0:
         raise APIError('register:failed', 'email', 'Email is already in use.')
     uid = next_id()
@@ -168,7 +209,7 @@ async def authenticate(*, email, passwd):
         raise APIValueError('email', 'Invalid email.')
     if not passwd:
         raise APIValueError('passwd', 'Invalid password.')
-    users = await User.findAll('email=?', [email])
+    users = await User.query().where(email=email).all()
     if len(users) == 0:
         raise APIValueError('email', 'Email not exist.')
     user = users[0]
@@ -215,14 +256,23 @@ def manage_comments(*, page='1'):
 
 # 获取评论数据api
 @get('/api/comments')
-async def api_comments(*, page='1'):
+async def api_comments(*, page='1', cursor=None):
+    if cursor is not None:
+        p = CursorPage(cursor, keyset=Comment.__keyset__)
+        comments = p.paginate(await Comment.findAll(limit=p.limit, compact=True, prefetch=['blog'], **p.seek))
+        return dict(page=p, comments=comments, blogs=blog_names(comments))
     page_index = get_page_index(page)
-    num = await Comment.findNumber('count(id)')
+    num = await Comment.count()
     p = Page(num, page_index)
     if num == 0:
-        return dict(page=p, comments=())
-    comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
-    return dict(page=p, comments=comments)
+        return dict(page=p, comments=(), blogs={})
+    comments = await Comment.query().order_by('-created_at').limit(p.limit).offset(p.offset).compact().prefetch('blog').all()
+    return dict(page=p, comments=comments, blogs=blog_names(comments))
+
+
+# 评论所属博客的标题，blog_id -> name，供管理页面显示
+def blog_names(comments):
+    return dict((c.blog_id, c.blog.name) for c in comments if c.blog is not None)
 
 
 # 获取博文管理页面，注意博文的实际数据是通过api获取的
@@ -236,13 +286,17 @@ def manage_blogs(*, page='1'):
 
 # 获取博文数据，模板页面通过此api拿到Model
 @get('/api/blogs')
-async def api_blogs(*, page='1'):
+async def api_blogs(*, page='1', cursor=None):
+    if cursor is not None:
+        p = CursorPage(cursor, keyset=Blog.__keyset__)
+        blogs = p.paginate(await Blog.findAll(limit=p.limit, compact=True, **p.seek))
+        return dict(page=p, blogs=blogs)
     page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')
+    num = await Blog.count()
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, blogs=())
-    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    blogs = await Blog.query().order_by('-created_at').limit(p.limit).offset(p.offset).compact().all()
     return dict(page=p, blogs=blogs)
 
 
@@ -257,18 +311,51 @@ def manage_users(*, page='1'):
 
 # 获取用户数据
 @get('/api/users')
-async def api_get_users(*, page='1'):
+async def api_get_users(*, page='1', cursor=None):
+    if cursor is not None:
+        p = CursorPage(cursor, keyset=User.__keyset__)
+        users = p.paginate(await User.findAll(limit=p.limit, compact=True, **p.seek))
+        for u in users:
+            u.passwd = '******'
+        return dict(page=p, users=users)
     page_index = get_page_index(page)
-    num = await User.findNumber('count(id)')
+    num = await User.count()
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, users=())
-    users = await User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    users = await User.query().order_by('-created_at').limit(p.limit).offset(p.offset).compact().all()
     for u in users:
         u.passwd = '******'
     return dict(page=p, users=users)
 
 
+# 连接池状态
+@get('/api/admin/pool')
+def api_pool_stats(request):
+    check_admin(request)
+    return orm.pool_stats()
+
+
+# 各模型的主键缓存和查询结果缓存的命中率
+@get('/api/admin/caches')
+def api_cache_stats(request):
+    check_admin(request)
+    return orm.cache_stats()
+
+
+# 按总耗时(或其他统计项)排序的前n条SQL语句，包括p50/p95/p99耗时和慢查询的执行计划
+@get('/api/admin/queries')
+def api_query_stats(request, *, n='20', order_by='total_time'):
+    check_admin(request)
+    if order_by not in ('total_time', 'calls', 'rows', 'avg_time', 'max_time', 'slow', 'timed_out', 'coalesced', 'p50', 'p95', 'p99'):
+        raise APIValueError('order_by', 'invalid order_by: %s' % order_by)
+    try:
+        n = int(n)
+    except ValueError:
+        raise APIValueError('n', 'n must be an integer.')
+    return dict(statements=orm.statement_stats(order_by)[:n])
+
+
 # 获取博文创建页面
 @get('/manage/blogs/create')
 def manage_create_blog():
@@ -347,7 +434,9 @@ async def api_create_comment(id, request, *, content):
     if blog is None:
         raise APIResourceNotFoundError('Blog')
     comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
-    await comment.save()
+    async with orm.transaction():    # 评论和博客的评论数同时成功或同时失败
+        await comment.save()
+        await Blog.comment_added(blog.id, comment.created_at)
     return comment
 
 
@@ -358,5 +447,7 @@ async def api_delete_comments(id, request):
     c = await Comment.find(id)
     if c is None:
         raise APIResourceNotFoundError('Comment')
-    await c.remove()
+    async with orm.transaction():
+        await c.remove()
+        await Blog.comment_removed(c.blog_id)
     return dict(id=id)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Primary key generators.
+
+Snowflake ids are time-ordered integers stored as BIGINT:
+
+    | milliseconds since EPOCH | worker id | sequence |
+
+The default layout (41 + 5 + 7 bits) keeps ids below 2**53, so they survive as JSON
+numbers in the browser, and allows 32 worker processes generating 128 ids per
+millisecond each. Every process needs its own worker id: set one explicitly (unique across
+all hosts), or let configure() lease a free one on this host with lease_worker_id().
+
+    >>> g = Snowflake(worker_id=3)
+    >>> a, b = g.next_id(), g.next_id()
+    >>> a < b and a < 2 ** 53
+    True
+    >>> g.worker_of(a)
+    3
+    >>> m = Snowflake(worker_id=3)
+    >>> m.id_at(EPOCH + 1.0) >> (m.worker_bits + m.sequence_bits)
+    1000
+'''
+
+__author__ = 'Frank Wang'
+
+import os, tempfile, threading, time, uuid
+
+EPOCH = 1420070400.0    # 2015-01-01 00:00:00 UTC，41位毫秒可以用到2084年
+
+
+def legacy_id():
+    ' the 50-character string id: 15-digit ms timestamp + uuid4 hex + 000. '
+    return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+
+
+class Snowflake(object):
+
+    def __init__(self, worker_id, worker_bits=5, sequence_bits=7, epoch=EPOCH):
+        self.worker_bits = worker_bits
+        self.sequence_bits = sequence_bits
+        self.epoch = epoch
+        if not 0 <= worker_id < (1 << worker_bits):    # 不能取模：不同的进程会得到相同的编号
+            raise ValueError('worker_id must be in [0, %d): %s' % (1 << worker_bits, worker_id))
+        self.worker_id = worker_id
+        self._max_sequence = (1 << sequence_bits) - 1
+        self._last = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def _generate(self, ms):
+        with self._lock:
+            if ms <= self._last:    # 同一毫秒内，或者时钟回拨：沿用上一个时间戳，保证id递增
+                ms = self._last
+                self._sequence += 1
+                if self._sequence > self._max_sequence:    # 这一毫秒的序号用完了，借用下一毫秒
+                    ms += 1
+                    self._sequence = 0
+            else:
+                self._sequence = 0
+            self._last = ms
+            return (ms << (self.worker_bits + self.sequence_bits)) | (self.worker_id << self.sequence_bits) | self._sequence
+
+    def next_id(self):
+        return self._generate(int((time.time() - self.epoch) * 1000))
+
+    # 为迁移的旧记录按created_at生成id：id总是递增，所以应使用单独的生成器并按时间顺序调用
+    def id_at(self, timestamp):
+        ' generate an id for a record created at timestamp (seconds), e.g. when migrating old records. '
+        return self._generate(int((timestamp - self.epoch) * 1000))
+
+    def timestamp_of(self, id):
+        return (id >> (self.worker_bits + self.sequence_bits)) / 1000.0 + self.epoch
+
+    def worker_of(self, id):
+        return (id >> self.sequence_bits) & ((1 << self.worker_bits) - 1)
+
+
+_generator = None
+_lease = None    # 持有锁的文件，进程退出时锁自动释放
+
+
+def lease_worker_id(lock_dir=None, worker_bits=5):
+    '''
+    Allocate a worker id that no other running process on this host holds, by taking an
+    exclusive lock on one of the files worker-<n>.lock in lock_dir for the life of the process.
+    '''
+    import fcntl
+    global _lease
+    lock_dir = lock_dir or os.path.join(tempfile.gettempdir(), 'awesome-ids')
+    os.makedirs(lock_dir, exist_ok=True)
+    for n in range(1 << worker_bits):
+        f = open(os.path.join(lock_dir, 'worker-%d.lock' % n), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:    # 被其他进程占用
+            f.close()
+            continue
+        if _lease is not None:
+            _lease.close()
+        _lease = f
+        return n
+    raise RuntimeError('all %d worker ids in %s are in use' % (1 << worker_bits, lock_dir))
+
+
+def configure(worker_id=None, lock_dir=None, **kw):
+    '''
+    Set up the process-wide generator. worker_id must be unique among all running processes
+    (of all hosts); None leases a free one on this host, which is only safe on a single host.
+    '''
+    global _generator
+    if worker_id is None:
+        worker_id = lease_worker_id(lock_dir, kw.get('worker_bits', 5))
+    _generator = Snowflake(worker_id, **kw)
+    return _generator
+
+
+def _default():
+    if _generator is None:    # 没有调用configure()的脚本
+        configure()
+    return _generator
+
+
+def next_id():
+    ' the default id generator of models with integer primary keys. '
+    return _default().next_id()
+
+
+def worker_id():
+    return _default().worker_id
+
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Logging setup: records are put on an in-memory queue by the request path and written to
+stderr by a background thread, so request latency does not depend on stderr throughput.
+
+Per-request debug lines go to the 'request' logger and are only built for traced requests:
+every request in debug mode, a sampled fraction of requests otherwise.
+
+    if logs.traced():
+        logs.request_log.debug('call with args: %s', kw)
+'''
+
+__author__ = 'Frank Wang'
+
+import atexit, contextvars, logging, logging.handlers, queue, random
+
+request_log = logging.getLogger('request')
+request_log.setLevel(logging.DEBUG)    # 是否输出由traced()决定，不受根日志级别限制
+
+_traced = contextvars.ContextVar('logs_traced', default=False)
+_options = dict(debug=False, sample_rate=0.0)
+_listener = None
+_queued = []    # 其他后台写入的QueuedHandler，退出时一起停止
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''
+    QueueHandler that never blocks: records are dropped (and counted) while the queue is full.
+    '''
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class QueuedHandler(DroppingQueueHandler):
+    '''
+    Puts records on its own bounded queue and writes them to handler from a background thread,
+    e.g. for a log file that must not be written on the event loop thread.
+    '''
+
+    def __init__(self, handler, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.handler = handler
+        self.listener = logging.handlers.QueueListener(self.queue, handler, respect_handler_level=True)
+        self.listener.start()
+        _queued.append(self)
+
+    def close(self):
+        if self in _queued:
+            _queued.remove(self)
+            self.listener.stop()    # 写完队列中剩余的记录
+            self.handler.close()
+        super().close()
+
+
+def setup_logging(debug=False, sample_rate=0.01, level=None, maxsize=10000):
+    '''
+    Route all logging through a bounded queue drained by a background thread.
+
+    In debug mode the root level is DEBUG and every request is traced; otherwise the root
+    level is INFO (or level) and a sample_rate fraction of requests is traced.
+    '''
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+    _options['debug'] = debug
+    _options['sample_rate'] = 1.0 if debug else sample_rate
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    q = queue.Queue(maxsize)
+    root.addHandler(DroppingQueueHandler(q))
+    root.setLevel(level if level is not None else (logging.DEBUG if debug else logging.INFO))
+    _listener = logging.handlers.QueueListener(q, stream, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def _stop():
+    if _listener is not None:
+        _listener.stop()    # 退出前写完队列中剩余的日志
+    for h in list(_queued):
+        h.close()
+
+atexit.register(_stop)
+
+
+def traced():
+    ' whether debug lines of the current request should be logged. '
+    return _traced.get()
+
+
+def start_request():
+    ' decide whether the current request is traced, returns a token for end_request(). '
+    rate = _options['sample_rate']
+    return _traced.set(rate >= 1.0 or (rate > 0.0 and random.random() < rate))
+
+
+def end_request(token):
+    _traced.reset(token)
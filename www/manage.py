@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Maintenance commands, run against the database configured in config.py:
+
+    python3 manage.py sync-indexes [--apply]
+    python3 manage.py repair-comment-stats [--batch-size 500]
+    python3 manage.py migrate-ids [--batch-size 1000]
+'''
+
+__author__ = 'Frank Wang'
+
+import argparse, asyncio, logging
+
+import orm, ids
+import models    # 导入模型，注册它们声明的表和索引
+from config import configs
+
+
+# 比较models.py中声明的索引与数据库中的索引，--apply时在线创建缺少的索引
+async def sync_indexes(args):
+    changes = await orm.sync_indexes(apply=args.apply)
+    for c in changes:
+        desc = '%s.%s (%s)%s' % (c['table'], c['name'], ', '.join(c['columns']), ' unique' if c['unique'] else '')
+        if c['action'] == 'create':
+            print('%s %s' % ('created:' if args.apply else 'missing:', c['sql']))
+        elif c['action'] == 'conflict':
+            print('conflict: %s differs from the index of the same name in the database' % desc)
+        else:
+            print('extra:   %s is not declared by any model' % desc)
+    if not changes:
+        print('indexes are in sync.')
+
+
+# 根据comments表重新计算blogs表中维护的评论数和最后评论时间
+async def repair_comment_stats(args):
+    rows = await models.Blog.repair_comment_stats(batch_size=args.batch_size)
+    print('repaired comment stats of %s blogs.' % rows)
+
+
+# 按(created_at, id)顺序分批把model的表复制到table，convert把每一行转换成新表的行，返回None表示跳过
+async def copy_table(model, table, batch_size, convert):
+    fields = [model.__primary_key__] + model.__fields__
+    insert = 'insert into `%s` (%s) values ' % (table, ', '.join(map(lambda f: '`%s`' % f, fields)))
+    select = 'select * from `%s` %%s order by `created_at`, `id` limit ?' % model.__table__
+    last = None
+    copied = skipped = 0
+    while True:
+        if last is None:
+            rs = await orm.select(select % '', [batch_size])
+        else:
+            rs = await orm.select(select % 'where (`created_at`, `id`) > (?, ?)', list(last) + [batch_size])
+        if not rs:
+            return copied, skipped
+        last = (rs[-1]['created_at'], rs[-1]['id'])
+        objs = [model(**r) for r in map(convert, rs) if r is not None]
+        skipped += len(rs) - len(objs)
+        if objs:
+            args = []
+            for obj in objs:
+                args.extend(map(obj.getValueOrDefault, fields))    # 旧表中没有的列使用默认值
+            await orm.execute(insert + orm.create_values_string(len(fields), len(objs)), args)
+            copied += len(objs)
+
+
+# 把博客和评论的字符串id换成ids.py生成的按时间递增的整数id：按created_at顺序复制到新表、改写评论的blog_id，
+# 最后改表名，原来的表保留为blogs_legacy和comments_legacy。迁移期间应停止应用，否则复制之后写入的记录会丢失
+async def migrate_ids(args):
+    rs = await orm.select('select `id` from `blogs` limit 1', [])
+    if rs and isinstance(rs[0]['id'], int):
+        print('ids are already migrated.')
+        return
+    for table in ('blogs_migrating', 'comments_migrating'):    # 清理上次中断的迁移
+        await orm.execute('drop table if exists `%s`' % table, ())
+    await orm.create_table(models.Blog, 'blogs_migrating')
+    await orm.create_table(models.Comment, 'comments_migrating')
+    blog_ids = dict()
+    blog_gen = ids.Snowflake(ids.worker_id())    # 生成的id总是递增，每个表按时间顺序使用单独的生成器
+    comment_gen = ids.Snowflake(ids.worker_id())
+
+    def convert_blog(r):
+        blog_ids[r['id']] = blog_gen.id_at(r['created_at'])
+        return dict(r, id=blog_ids[r['id']])
+
+    def convert_comment(r):
+        blog_id = blog_ids.get(r['blog_id'])
+        if blog_id is None:    # 博客已被删除的评论不再迁移
+            return None
+        return dict(r, id=comment_gen.id_at(r['created_at']), blog_id=blog_id)
+
+    print('copied %s blogs, skipped %s.' % await copy_table(models.Blog, 'blogs_migrating', args.batch_size, convert_blog))
+    print('copied %s comments, skipped %s orphans.' % await copy_table(models.Comment, 'comments_migrating', args.batch_size, convert_comment))
+    await orm.rename_tables([('blogs', 'blogs_legacy'), ('blogs_migrating', 'blogs'),
+                             ('comments', 'comments_legacy'), ('comments_migrating', 'comments')])
+    await models.Blog.repair_comment_stats(batch_size=args.batch_size)    # 孤立的评论没有迁移，重新计算评论数
+    print('done, the old tables are kept as blogs_legacy and comments_legacy.')
+
+
+async def run(loop, args):
+    ids.configure(configs.ids.worker_id, configs.ids.lock_dir)
+    await orm.create_pool(loop=loop, **configs.db)
+    try:
+        await args.func(args)
+    finally:
+        await orm.close_pool()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintenance commands of awesome-python3-webapp.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    p = commands.add_parser('sync-indexes', help='diff the indexes declared by the models against the database.')
+    p.add_argument('--apply', action='store_true', help='create the missing indexes online.')
+    p.set_defaults(func=sync_indexes)
+    p = commands.add_parser('repair-comment-stats', help='recompute Blog.comment_count and Blog.last_comment_at from the comments table.')
+    p.add_argument('--batch-size', type=int, default=500, help='blogs updated per statement.')
+    p.set_defaults(func=repair_comment_stats)
+    p = commands.add_parser('migrate-ids', help='replace the string ids of blogs and comments with time-ordered integer ids.')
+    p.add_argument('--batch-size', type=int, default=1000, help='rows copied per statement.')
+    p.set_defaults(func=migrate_ids)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(loop, args))
+
+if __name__=='__main__':
+    main()
@@ -7,18 +7,24 @@ Models for user, blog, comment.
 
 __author__ = 'Frank Wang'
 
-import time, uuid
+import time
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+import ids
+from orm import Model, Index, StringField, BooleanField, IntegerField, FloatField, TextField, select, execute, create_in_args
 
+# 用户的id仍是字符串：密码的sha1以用户id为盐，改变id会使所有密码失效
 def next_id():
-    return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+    return ids.legacy_id()
 
 class User(Model):
     __table__ = 'users'
+    __cache__ = dict(ttl=60, maxsize=10000)    # cookie2user每个请求都会按主键查找用户
+    __counter__ = dict(ttl=300)
+    __batch__ = True    # 高峰时大量请求同时查找用户，合并成一次in查询
+    __indexes__ = [Index('created_at', name='idx_create_at')]    # 沿用已部署数据库中的索引名
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(ddl='varchar(50)')
+    email = StringField(ddl='varchar(50)', unique=True)    # 登录时按email查找
     passwd = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
@@ -27,23 +33,63 @@ class User(Model):
 
 class Blog(Model):
     __table__ = 'blogs'
+    __cache__ = dict(ttl=60, maxsize=1000)
+    __counter__ = dict(ttl=300)    # 首页和博客列表需要博客总数
+    __batch__ = True
+    __query_cache__ = dict(ttl=60, maxsize=500)    # 首页和博客列表的查询在有人发表博客之前结果都相同
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')    # 注意每篇博文都有id
-    user_id = StringField(ddl='varchar(50)')
+    id = IntegerField(primary_key=True, default=ids.next_id)    # 注意每篇博文都有id，按时间递增的64位整数
+    user_id = StringField(ddl='varchar(50)', references='User')    # Blog.prefetch(blogs, 'user')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    content = TextField(defer=True, ddl='mediumtext')    # 列表页不需要正文，findAll默认不查询
+    created_at = FloatField(default=time.time, index=True)
+    comment_count = IntegerField()    # 评论数和最后评论时间是comments表的聚合，列表页显示时不需要再count
+    last_comment_at = FloatField()
+
+    # 以下方法应与评论的写操作在同一个orm.transaction()中调用
+    @classmethod
+    async def comment_added(cls, blog_id, created_at):
+        await cls.update_columns(blog_id, '`comment_count`=`comment_count`+1, `last_comment_at`=?', [created_at])
+
+    @classmethod
+    async def comment_removed(cls, blog_id):
+        await cls.update_columns(blog_id, '`comment_count`=case when `comment_count`>0 then `comment_count`-1 else 0 end, '
+                                 '`last_comment_at`=coalesce((select max(`created_at`) from `comments` where `blog_id`=?), 0)', [blog_id])
+
+    # 根据comments表重新计算所有博客的评论数和最后评论时间，按主键分批执行，每批一条update，返回修改的行数
+    @classmethod
+    async def repair_comment_stats(cls, batch_size=500):
+        rows = 0
+        last = None    # 第一批不带条件，不依赖主键类型的"最小值"
+        while True:
+            if last is None:
+                rs = await select('select `id` from `blogs` order by `id` limit ?', [batch_size])
+            else:
+                rs = await select('select `id` from `blogs` where `id`>? order by `id` limit ?', [last, batch_size])
+            if not rs:
+                return rows
+            pks = [r['id'] for r in rs]
+            placeholders, args = create_in_args(pks)
+            rows += await execute('update `blogs` set '
+                                  '`comment_count`=(select count(*) from `comments` where `comments`.`blog_id`=`blogs`.`id`), '
+                                  '`last_comment_at`=coalesce((select max(`created_at`) from `comments` where `comments`.`blog_id`=`blogs`.`id`), 0) '
+                                  'where `id` in (%s)' % placeholders, args)
+            cls.invalidate(*pks)
+            last = pks[-1]
 
 class Comment(Model):
     __table__ = 'comments'
+    __counter__ = dict(ttl=300, keys=('blog_id',))    # 同时维护每篇博客的评论数
+    __query_cache__ = dict(ttl=60, maxsize=1000)    # 博客页面的评论列表
+    __indexes__ = [('blog_id', 'created_at')]    # 博客页面按blog_id查找评论并按时间排序，不再全表扫描
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')    # 评论也有id
-    blog_id = StringField(ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    id = IntegerField(primary_key=True, default=ids.next_id)    # 评论也有id
+    blog_id = IntegerField(default=None, references='Blog')    # 没有默认值，评论必须属于某篇博客
+    user_id = StringField(ddl='varchar(50)', references='User')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    content = TextField(ddl='mediumtext')
+    created_at = FloatField(default=time.time, index=True)
@@ -2,9 +2,11 @@
 # -*- coding: utf-8 -*-
 
 
-import asyncio, logging
+import asyncio, contextlib, contextvars, json, logging, logging.handlers, random, time, weakref
 
-import aiomysql
+import logs
+from backends import get_backend
+from cache import LRUCache, RowCounter
 
 __author__ = 'Frank Wang'
 
@@ -13,23 +15,528 @@ logging.basicConfig(level=logging.INFO)
 
 
 def log(sql, args=()):    # sql是一种什么对象？
-    logging.info('SQL: %s' % sql)
+    if logs.traced():    # 被抽样的请求输出执行的每条SQL
+        logs.request_log.debug('SQL: %s args: %s', sql, args)
+    elif logging.root.isEnabledFor(logging.DEBUG):    # 热路径上只在DEBUG时才格式化日志
+        logging.debug('SQL: %s args: %s', sql, args)
+
+
+# 语句缓存：ORM只会执行少量固定形状的SQL(__select__, __insert__, __update__, __delete__及findAll/findNumber的变体)，
+# 因此按?占位符形式的SQL缓存转换后的驱动SQL，同时记录每条语句的执行统计
+_MAX_STATEMENTS = 1000
+_statements = dict()
+
+
+class Statement(object):
+    '''
+    A cached SQL statement: the ?-style sql, the translated driver sql and per-statement counters.
+    '''
+
+    __slots__ = ('sql', 'driver_sql', 'calls', 'rows', 'total_time', 'max_time', 'coalesced', 'slow', 'timed_out', 'samples', 'plan', 'explaining')
+
+    reservoir = 512    # 每条语句最多保留多少个耗时样本用于计算百分位数
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.driver_sql = sql.replace('?', _backend.placeholder)    # SQL语句占位符是?，而MySQL语句占位符是%s，只在第一次遇到时替换
+        self.calls = 0
+        self.rows = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.coalesced = 0    # 搭了正在执行的相同查询的便车、没有访问数据库的调用次数
+        self.slow = 0
+        self.timed_out = 0    # 超时被终止的次数
+        self.samples = []
+        self.plan = None    # 慢查询的EXPLAIN结果
+        self.explaining = False
+
+    @property
+    def avg_time(self):
+        return self.total_time / self.calls if self.calls else 0.0
+
+    def record(self, rows, elapsed, timed_out=False):
+        self.calls += 1
+        if timed_out:
+            self.timed_out += 1
+        self.rows += rows
+        self.total_time += elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+        if len(self.samples) < self.reservoir:    # 蓄水池抽样：样本数固定，每次执行被保留的概率相同
+            self.samples.append(elapsed)
+        else:
+            i = random.randrange(self.calls)
+            if i < self.reservoir:
+                self.samples[i] = elapsed
+
+    def percentile(self, p):
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+    def to_dict(self):
+        return dict(sql=self.sql, calls=self.calls, rows=self.rows, total_time=self.total_time,
+                    avg_time=self.avg_time, max_time=self.max_time, coalesced=self.coalesced, slow=self.slow, timed_out=self.timed_out,
+                    p50=self.percentile(50), p95=self.percentile(95), p99=self.percentile(99), plan=self.plan)
+
+    def __str__(self):
+        return '<Statement calls: %s, avg: %.6fs, max: %.6fs: %s>' % (self.calls, self.avg_time, self.max_time, self.sql)
+
+    __repr__ = __str__
+
+
+def get_statement(sql):
+    ' get the cached statement for sql, compile it on first use. '
+    stmt = _statements.get(sql)
+    if stmt is None:
+        stmt = Statement(sql)
+        if len(_statements) < _MAX_STATEMENTS:    # 拼接了字面量的SQL可能无限增长，超出上限后不再缓存
+            _statements[sql] = stmt
+            logging.info('SQL: %s', sql)    # 每种语句只在第一次出现时以INFO级别记录
+    return stmt
+
+
+def statement_stats(order_by='total_time'):
+    ' return per-statement counters, sorted descending by order_by. '
+    return sorted((s.to_dict() for s in _statements.values()), key=lambda d: d[order_by], reverse=True)
+
+
+def reset_statement_stats():
+    for s in _statements.values():
+        s.calls = s.rows = s.coalesced = s.slow = s.timed_out = 0
+        s.total_time = s.max_time = 0.0
+        s.samples = []
+        s.plan = None
+
+
+# 慢查询日志：超过slow_query秒的语句以一行JSON记录到orm.slow日志(配置slow_log时写入按大小轮转的文件)，
+# 慢的SELECT在后台执行一次EXPLAIN，执行计划同样记录到日志并保存在语句统计中
+_slow_log = logging.getLogger('orm.slow')
+
+
+def _open_slow_log(path, max_bytes=10 * 1024 * 1024, backup_count=5):
+    for h in list(_slow_log.handlers):
+        _slow_log.removeHandler(h)
+        h.close()
+    if not path:
+        _slow_log.propagate = True
+        return
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    _slow_log.addHandler(logs.QueuedHandler(handler))    # 文件由后台线程写入，不阻塞事件循环
+    _slow_log.propagate = False    # 结构化的日志只写入文件
+
+
+def _check_slow(stmt, args, rows, elapsed, timed_out=False):
+    threshold = _pool_options['slow_query']
+    if threshold is None or elapsed < threshold:
+        return
+    stmt.slow += 1
+    _slow_log.warning('%s', json.dumps(dict(event='slow_query', time=time.time(), sql=stmt.sql, elapsed=elapsed, rows=rows, timed_out=timed_out)))
+    if stmt.plan is None and not stmt.explaining and stmt.sql.lstrip()[:6].lower() == 'select':    # 每种语句只EXPLAIN一次
+        stmt.explaining = True
+        contextvars.Context().run(asyncio.ensure_future, _explain(stmt, args))    # 不继承调用者的事务，不阻塞调用者
+
+
+async def _explain(stmt, args):
+    try:
+        async with _connection(_read_pool()) as conn:
+            async with _backend.cursor(conn) as cur:
+                await cur.execute('%s %s' % (_backend.explain, stmt.driver_sql), args or ())
+                stmt.plan = await cur.fetchall()
+        _slow_log.warning('%s', json.dumps(dict(event='explain', time=time.time(), sql=stmt.sql, plan=stmt.plan), default=str))
+    except Exception as e:
+        logging.warning('failed to explain %s: %s', stmt.sql, e)
+    finally:
+        stmt.explaining = False
+
+# 连接池耗尽(等待超时或排队的协程过多)时抛出，由app的中间件转换成503
+class PoolExhaustedError(Exception):
+    pass
+
+
+# 查询超过timeout或者请求的截止时间时抛出，查询已在服务端被终止，由app的中间件转换成504
+class QueryTimeoutError(Exception):
+    pass
+
+
+# 截止时间：用法 with orm.deadline(10): ...，其中的所有查询(包括等待连接)共享剩余的时间。
+# app的中间件为每个请求设置截止时间，嵌套使用时取较早的截止时间
+_deadline = contextvars.ContextVar('orm_deadline', default=None)
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    at = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(at if current is None else min(current, at))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+# 查询实际可用的时间：timeout和截止时间剩余时间中较短的一个，None表示不限制
+def _query_timeout(timeout=None):
+    at = _deadline.get()
+    if at is not None:
+        remaining = at - time.monotonic()
+        if remaining <= 0:
+            raise QueryTimeoutError('request deadline exceeded')
+        if timeout is None or remaining < timeout:
+            timeout = remaining
+    return timeout
+
+
+_CANCEL_GRACE = 1.0    # 终止查询后最多等待多少秒让连接恢复可用，超过则丢弃连接
+
+
+# 在timeout秒内完成查询。超时(或调用者被取消)时在服务端终止查询，等查询结束、连接恢复干净的状态后才返回，
+# 这样归还连接池的连接不会还有未读完的结果。不能直接取消查询的协程，那样会让驱动的协议状态错乱
+async def _run_query(conn, query, timeout, sql):
+    task = asyncio.ensure_future(query)    # 没有timeout时也要在被取消时终止服务端的查询
+    try:
+        done, pending = await asyncio.wait([task], timeout=timeout)
+    except asyncio.CancelledError:
+        await _abort_query(conn, task)
+        raise
+    if done:
+        return task.result()
+    await _abort_query(conn, task)
+    raise QueryTimeoutError('query exceeded %.3fs: %s' % (timeout, sql))
+
+
+async def _abort_query(conn, task):
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())    # 被终止的查询的异常已经处理过
+    try:
+        await _backend.cancel_query(conn)
+    except Exception as e:
+        logging.warning('failed to cancel query: %s', e)
+    done, pending = await asyncio.wait([task], timeout=_CANCEL_GRACE)
+    if not done:    # 查询没有及时结束，连接不能再使用
+        await _backend.discard_connection(conn)
+
+
+class PoolStats(object):
+    '''
+    Live gauges and counters of the connection pool, including a histogram of acquire wait times.
+    '''
+
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, float('inf'))    # 等待时间直方图的上界(秒)
+
+    def __init__(self):
+        self.waiters = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.histogram = [0] * len(self.buckets)
+
+    def observe(self, wait):
+        self.acquired += 1
+        for i, b in enumerate(self.buckets):
+            if wait <= b:
+                self.histogram[i] += 1
+                break
+
+
+_backend = get_backend('mysql')    # 存储后端，见backends.py
+_pool_stats = dict()    # 每个连接池对应一个PoolStats
+_pool_options = dict(acquire_timeout=None, max_waiters=None, sticky_window=0, coalesce_reads=False, slow_query=None)
+__pool = None    # 主库的连接池，见create_pool()
+__replicas = []    # 只读副本的连接池
+_next_replica = 0
+_sticky_until = contextvars.ContextVar('orm_sticky_until', default=0.0)    # 写操作之后在这个时间(time.time())之前的读都走主库
+
+
+async def _create_pool(loop, kw):
+    pool = await _backend.create_pool(loop, **kw)
+    _pool_stats[pool] = PoolStats()
+    logging.info('database connection pool ready (%s): minsize=%s, maxsize=%s', _backend.name, pool.minsize, pool.maxsize)
+    return pool
+
 
 # 创建连接池，每个http请求都可以从连接池中直接获取数据库连接。使用连接池的好处是不必频繁地打开和关闭数据库连接，而是能复用就尽量复用
+# replicas是只读副本的配置列表，每一项覆盖主库配置中的对应项(通常只有host/port)；select和Model的查找走副本，execute走主库
+# backend选择存储后端：mysql(默认)或sqlite(嵌入式，path指定数据库文件，用于测试和性能测试)
 async def create_pool(loop, **kw):
     logging.info('create database connection pool...')    # 打印日志
+    global __pool, __replicas, _backend
+    _backend = get_backend(kw.get('backend', 'mysql'))
+    _statements.clear()    # 缓存的驱动SQL与后端的占位符有关
+    for model in _models.values():    # 换了数据库，进程内缓存的数据都不再有效
+        if model.__pk_cache__ is not None:
+            model.__pk_cache__.clear()
+        if model.__row_counter__ is not None:
+            model.__row_counter__.clear()
+        if model.__result_cache__ is not None:
+            model.__result_cache__.clear()
+    __pool = await _create_pool(loop, kw)
+    replicas = []
+    for r in kw.get('replicas', None) or ():
+        replica = dict(kw)
+        replica.update(r)
+        replicas.append(await _create_pool(loop, replica))
+    __replicas = replicas
+    _pool_options['acquire_timeout'] = kw.get('acquire_timeout', None)    # 获取连接最多等待的秒数，None表示一直等待
+    _pool_options['max_waiters'] = kw.get('max_waiters', None)    # 最多允许多少个协程排队等待连接，None表示不限制
+    _pool_options['sticky_window'] = kw.get('sticky_window', 5)    # 写操作之后多少秒内的读仍然走主库，保证读到自己的写
+    _pool_options['coalesce_reads'] = kw.get('coalesce_reads', False)    # select()的coalesce参数的默认值
+    _pool_options['slow_query'] = kw.get('slow_query', None)    # 慢查询阈值(秒)，None表示不记录
+    _open_slow_log(kw.get('slow_log', None))
+
+
+# 选择读连接池：没有副本或者刚写过时(primary为None时由当前上下文决定)用主库，否则选正在使用的连接最少的副本
+def _read_pool(primary=None):
+    global __pool, __replicas, _next_replica
+    replicas = __replicas
+    if primary is None:
+        primary = _reads_primary()
+    if not replicas or primary:
+        return __pool
+    n = len(replicas)
+    _next_replica = (_next_replica + 1) % n    # 从轮转的位置开始比较，空闲的副本轮流分担负载
+    best = None
+    for i in range(n):
+        pool = replicas[(_next_replica + i) % n]
+        if best is None or pool.size - pool.freesize < best.size - best.freesize:
+            best = pool
+    return best
+
+
+def _reads_primary():
+    return _sticky_until.get() > time.time()
+
+
+# 读缓存的结果是否可以写入缓存：主库上读到的总是可以；副本在表修改之后sticky_window秒内可能还是旧的，
+# 在这段时间内从副本读到的结果不写入缓存，否则刚写过数据的请求会从缓存中读到修改之前的记录。
+# 注意缓存在每个进程中各自维护，一个进程中的写操作不会使其他进程的缓存失效
+def _cacheable_read(model):
+    return not __replicas or _reads_primary() or time.time() >= model.__unsettled_until__
+
+
+def _unsettle(model):
+    if __replicas:
+        model.__unsettled_until__ = time.time() + _pool_options['sticky_window']
+
+
+def _stick_to_primary():
+    window = _pool_options['sticky_window']
+    if window and __replicas:    # 没有副本时所有读本来就走主库
+        _sticky_until.set(time.time() + window)
+
+
+# 读自己的写跨越请求：写过数据的请求把primary_until()交给客户端(例如cookie)，
+# 同一客户端之后的请求用read_primary_until()恢复，这样任何进程处理的后续请求都读主库
+def primary_until():
+    ' the time (time.time()) until which reads of the current context go to the primary, 0 if they do not. '
+    return _sticky_until.get()
+
+
+def read_primary_until(until):
+    ' make reads of the current context go to the primary until the given time, at most sticky_window seconds from now. '
+    until = min(until, time.time() + _pool_options['sticky_window'])    # 客户端提供的值不可信，不能让它一直读主库
+    if until > _sticky_until.get():
+        _sticky_until.set(until)
+
+
+# 从连接池获取连接：记录等待时间，超时或排队过长时快速失败
+@contextlib.asynccontextmanager
+async def _connection(pool=None):
     global __pool
-    __pool  = await aiomysql.create_pool(    # create_pool(minsize=1, maxsize=10, loop=None, **kwargs)  A coroutine that create a pool of connection to MySQL database.
-        host=kw.get('host', 'localhost'),    # dict有get方法, key=host, default=localhost
-        port=kw.get('port', 3306),        #
-        user=kw['user'],
-        password=kw['password'],
-        db=kw['db'],
-        charset=kw.get('charset','utf8'),
-        autocommit=kw.get('maxsize',10),
-        minsize=kw.get('minsize',1),
-        loop=loop
-    )
+    if pool is None:
+        pool = __pool
+    stats = _pool_stats[pool]
+    max_waiters = _pool_options['max_waiters']
+    if max_waiters is not None and pool.freesize == 0 and pool.size >= pool.maxsize and stats.waiters >= max_waiters:
+        stats.rejected += 1
+        raise PoolExhaustedError('too many coroutines waiting for a connection: %s' % stats.waiters)
+    limit = _pool_options['acquire_timeout']
+    wait = _query_timeout(limit)    # 等待连接的时间也计入请求的截止时间
+    start = time.perf_counter()
+    stats.waiters += 1
+    try:
+        conn = await asyncio.wait_for(pool.acquire(), wait)
+    except asyncio.TimeoutError:
+        stats.timeouts += 1
+        if wait != limit:
+            raise QueryTimeoutError('request deadline exceeded while waiting for a connection')
+        raise PoolExhaustedError('no connection available within %ss' % limit)
+    finally:
+        stats.waiters -= 1
+    stats.observe(time.perf_counter() - start)
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+def _gauges(pool):
+    stats = _pool_stats[pool]
+    return dict(size=pool.size, in_use=pool.size - pool.freesize, idle=pool.freesize,
+                minsize=pool.minsize, maxsize=pool.maxsize, waiters=stats.waiters,
+                acquired=stats.acquired, timeouts=stats.timeouts, rejected=stats.rejected,
+                acquire_wait=[('<=%ss' % b, n) for b, n in zip(stats.buckets, stats.histogram)])
+
+
+async def close_pool():
+    global __pool, __replicas
+    pools = ([__pool] if __pool is not None else []) + __replicas    # 创建连接池之前失败时也可以调用
+    __pool, __replicas = None, []
+    for pool in pools:
+        pool.close()
+        await pool.wait_closed()
+
+
+# 根据Model的定义和schema.sql中声明的索引建表，用于嵌入式的SQLite后端(MySQL请直接执行schema.sql)
+async def create_tables(models=None):
+    for model in models or _models.values():
+        await create_table(model)
+
+
+# table用于在另一个表名下创建模型的表，例如迁移时先建新表再改名
+async def create_table(model, table=None):
+    for sql in _backend.create_table_sql(model, table):
+        await execute(sql, ())
+
+
+# 按顺序改表名，pairs为[(旧表名, 新表名), ...]
+async def rename_tables(pairs):
+    for sql in _backend.rename_tables_sql(pairs):
+        await execute(sql, ())
+
+
+# 比较模型声明的索引和数据库中已有的索引(MySQL查询information_schema)，apply为True时在线创建缺少的索引
+# 返回的每一项：action为create(缺少)、conflict(同名但列不同，需要人工处理)或extra(数据库中有但没有声明)
+async def sync_indexes(models=None, apply=False):
+    changes = []
+    for model in models or _models.values():
+        async with _connection() as conn:
+            existing = await _backend.table_indexes(conn, model.__table__)
+        declared = set()
+        for name, columns, unique in model.__indexes__:
+            match = [n for n, (cs, u) in existing.items() if cs == list(columns) and u == unique]    # 列相同的索引已经存在，名称不同也不重复创建
+            if match:
+                declared.update(match)
+                continue
+            change = dict(table=model.__table__, name=name, columns=list(columns), unique=unique)
+            if name in existing:
+                declared.add(name)
+                change.update(action='conflict', sql=None)
+            else:
+                change.update(action='create', sql=_backend.add_index_sql(model.__table__, name, columns, unique))
+            changes.append(change)
+        for name, (columns, unique) in existing.items():
+            if name not in declared:
+                changes.append(dict(table=model.__table__, name=name, columns=columns, unique=unique, action='extra', sql=None))
+    if apply:
+        for change in changes:
+            if change['action'] == 'create':
+                logging.info('create index: %s', change['sql'])
+                await execute(change['sql'], ())
+    return changes
+
+
+# 各模型的缓存命中情况
+def cache_stats():
+    return {model.__name__: dict(pk=model.cache_stats(), query=model.query_cache_stats()) for model in _models.values()}
+
+
+def pool_stats():
+    ' return gauges of the connection pools: in use, idle, waiters and the acquire wait histogram. '
+    global __pool, __replicas
+    stats = _gauges(__pool)
+    stats['replicas'] = [_gauges(p) for p in __replicas]
+    return stats
+
+# 事务：把一个连接固定在当前协程(以及它创建的任务)的上下文中，块内所有的select/execute/Model调用都使用这个连接
+_transaction = contextvars.ContextVar('orm_transaction', default=None)
+
+
+class Transaction(object):
+    '''
+    A transaction pinned to one pooled connection, created by orm.transaction().
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = asyncio.Lock()    # 同一个连接上的语句必须串行执行
+        self.touched = set()    # 事务中写过的(model, pk)，提交或回滚后需要再次使缓存失效
+        self.partial_rollback = False    # 是否回滚过SAVEPOINT
+        self._savepoints = 0
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        async with self.lock:
+            yield self.conn
+
+    async def _execute(self, sql):
+        async with self.connection() as conn:
+            async with _backend.cursor(conn) as cur:
+                await cur.execute(sql)
+
+    def touch(self, model, pk):
+        self.touched.add((model, pk))
+
+    def _finish(self, committed):
+        # 事务期间其他请求可能把旧数据重新放进缓存，提交或回滚之后再失效一次
+        for model, pk in self.touched:
+            model._invalidate(pk)
+            if (not committed or self.partial_rollback) and model.__row_counter__ is not None:
+                model.__row_counter__.clear()    # 回滚后已经加减过的计数不再可信
+
+
+def in_transaction():
+    return _transaction.get() is not None
+
+
+# 用法：
+# async with orm.transaction() as tx:
+#     await comment.save()
+#     await blog.update()
+# 正常退出时提交，发生异常时回滚；嵌套使用时创建SAVEPOINT，只回滚内层的修改
+@contextlib.asynccontextmanager
+async def transaction():
+    tx = _transaction.get()
+    if tx is not None:
+        tx._savepoints += 1
+        name = 'sp_%s' % tx._savepoints
+        await tx._execute('SAVEPOINT %s' % name)
+        try:
+            yield tx
+        except BaseException:
+            await tx._execute('ROLLBACK TO SAVEPOINT %s' % name)
+            tx.partial_rollback = True
+            raise
+        else:
+            await tx._execute('RELEASE SAVEPOINT %s' % name)
+        return
+    async with _connection() as conn:    # 事务总是使用主库
+        await conn.begin()
+        tx = Transaction(conn)
+        token = _transaction.set(tx)
+        committed = False
+        try:
+            yield tx
+        except BaseException:
+            await conn.rollback()
+            raise
+        else:
+            await conn.commit()
+            committed = True
+        finally:
+            _transaction.reset(token)
+            _wrote()    # 提交之前开始的读可能还没有读到事务的修改
+            tx._finish(committed)
+
+
+# 在事务中使用事务的连接，否则从连接池获取，读操作可以使用副本
+def _statement_connection(read=False, primary=None):
+    tx = _transaction.get()
+    if tx is not None:
+        return tx.connection()
+    return _connection(_read_pool(primary) if read else None)
+
 
 # Cursors allow Python code to execute MySQL command in a database session. They are bound to the connection for the
 # entire lifetime and all the commands are executed in the context of the database wrapped by the connection.
@@ -37,38 +544,161 @@ async def create_pool(loop, **kw):
 # For example, getting all rows where id is 5: yield from cursor.execute("SELECT * FROM t1 WHERE id=%s", (5,))
 # Return number of rows that has been produced of affected.
 # DictCursor A cursor which returns results as a dictionary. All methods and arguments same as Cursor.
-async def select(sql, args, size=None):    #sql是需要执行的select语句，args需要替换的参数, size是选择的行数
+# coalesce为True时(默认取连接池的coalesce_reads配置)，与正在执行的相同(sql, args, size)查询共享结果，
+# 流量突增时同一个查询最多只占用一个连接。共享的结果不能被调用者修改
+# timeout是查询最多执行的秒数，同时受请求截止时间(见deadline())的限制，超时抛出QueryTimeoutError。
+# 共享的查询不受任何一个调用者的timeout和截止时间限制，每个调用者只在等待结果时各自超时，
+# 所有调用者都离开(超时或被取消)后才在服务端终止查询
+async def select(sql, args, size=None, coalesce=None, timeout=None):    #sql是需要执行的select语句，args需要替换的参数, size是选择的行数
+    if coalesce is None:
+        coalesce = _pool_options['coalesce_reads']
+    if not coalesce or in_transaction():    # 事务中的查询可能读到未提交的修改，不与其他请求共享
+        return await _select(sql, args, size, timeout)
+    primary = _reads_primary()
+    key = (sql, tuple(args or ()), size, primary, _writes)    # 刚写过的请求读主库，不能共享副本上的结果；写操作之后的读不加入之前开始的查询
+    shared = _inflight.get(key)
+    if shared is None:
+        fut = contextvars.Context().run(asyncio.ensure_future, _select(sql, args, size, primary=primary))    # 不继承第一个调用者的截止时间
+        shared = _inflight[key] = _SharedQuery(fut)
+
+        def done(f):
+            if _inflight.get(key) is shared:
+                del _inflight[key]
+        fut.add_done_callback(done)
+    else:
+        get_statement(sql).coalesced += 1
+    shared.waiters += 1
+    try:
+        return await _wait_shared(shared.future, timeout)
+    finally:
+        shared.waiters -= 1
+        if not shared.waiters and not shared.future.done():    # 没有调用者在等待结果了，终止查询
+            if _inflight.get(key) is shared:
+                del _inflight[key]
+            shared.future.cancel()
+
+
+class _SharedQuery(object):
+
+    __slots__ = ('future', 'waiters')
+
+    def __init__(self, future):
+        self.future = future
+        self.waiters = 0
+
+
+# 等待共享的结果：一个调用者被取消或超时不影响等待同一结果的其他调用者
+async def _wait_shared(fut, timeout=None):
+    try:
+        return await asyncio.wait_for(asyncio.shield(fut), _query_timeout(timeout))
+    except asyncio.TimeoutError:
+        raise QueryTimeoutError('query exceeded the deadline of the caller')
+
+
+_inflight = dict()    # 正在执行的查询：(sql, args, size, reads_primary, writes) -> _SharedQuery
+_writes = 0    # 本进程完成的写操作(以及事务的提交和回滚)次数
+
+
+def _wrote():
+    global _writes
+    _writes += 1
+
+
+async def _select(sql, args, size=None, timeout=None, primary=None):
+    stmt = get_statement(sql)
     log(sql, args)
-    global __pool
-    async with __pool.get() as conn:    # 为什么不是acquire()
-        async with conn.cursor(aiomysql.DictCursor) as cur:    # conn.cursor() is a coroutine that creates a new cursor using the connection. return a cursor instance.
-            await cur.execute(sql.replace('?', '%s'), args or ())    #SQL语句占位符是?，而MySQL语句占位符是%s，select()函数自动在内部替换。
-            if size:
-                rs = await cur.fetchmany(size)    # 如果传入size 参数，就通过fetchmany()获取最多指定数量的记录 return list of fetched rows
-            else:
-                rs = await cur.fetchall()    # return all rows
-        logging.info('rows returned: %s' % len(rs))
-        return rs
+    start = time.perf_counter()
+    try:
+        async with _statement_connection(read=True, primary=primary) as conn:    # 从连接池(副本或当前事务)获取连接，见_connection()
+            rs = await _run_query(conn, _fetch(conn, stmt.driver_sql, args, size), _query_timeout(timeout), sql)
+    except QueryTimeoutError:
+        _record_timeout(stmt, args, start)
+        raise
+    elapsed = time.perf_counter() - start
+    stmt.record(len(rs), elapsed)
+    _check_slow(stmt, args, len(rs), elapsed)
+    return rs
 
-# execute()和select()不同的是，cursor对象不返回结果集，而通过rowcount返回结果数
-async def execute(sql, args, autocommit=True):
-    log(sql.replace('?', '%s')+str(args))
-    async with __pool.get() as conn:
-        if not autocommit:
-            await conn.begin()
+
+# 超时的语句同样计入统计和慢查询日志，否则最慢的那些执行不会出现在任何地方
+def _record_timeout(stmt, args, start):
+    elapsed = time.perf_counter() - start
+    stmt.record(0, elapsed, timed_out=True)
+    _check_slow(stmt, args, 0, elapsed, timed_out=True)
+
+
+async def _fetch(conn, sql, args, size):
+    async with _backend.cursor(conn) as cur:    # conn.cursor() is a coroutine that creates a new cursor using the connection. return a cursor instance.
+        await cur.execute(sql, args or ())    # 使用缓存的驱动SQL，不再每次调用都替换占位符
+        if size:
+            return await cur.fetchmany(size)    # 如果传入size 参数，就通过fetchmany()获取最多指定数量的记录 return list of fetched rows
+        return await cur.fetchall()    # return all rows
+
+# 流式查询：使用服务端(非缓冲)游标，每次只在内存中保留一批记录。用法：
+# async for row in stream(sql, args, chunk=1000): ...
+# 如果消费者提前停止，应调用aclose()(例如使用contextlib.aclosing)，否则要等到生成器被回收时才释放连接
+# 流式查询在读取期间会独占连接，所以总是使用单独的连接，不参与当前事务
+async def stream(sql, args, chunk=1000):
+    stmt = get_statement(sql)
+    log(sql, args)
+    start = time.perf_counter()
+    rows = 0
+    async with _connection(_read_pool()) as conn:
+        finished = False
+        cur = None
         try:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args)
-                affected = cur.rowcount    # Returns the number of rows that has been produced of affected.
-            if not autocommit:    # 为什么每执行一次都要检测autocommit?
-                await conn.commit()
-        except BaseException as e:
-            if not autocommit:
-                await conn.rollback()    # 如果执行失败，则回滚
-            raise    # 收集异常，但不处理
+            cur = await _backend.stream_cursor(conn)
+            await cur.execute(stmt.driver_sql, args or ())
+            while True:
+                rs = await cur.fetchmany(chunk)
+                if not rs:
+                    break
+                rows += len(rs)
+                for r in rs:
+                    yield r
+            await cur.close()
+            finished = True
         finally:
-            conn.close()
-        return affected
+            if not finished:
+                await _backend.discard_stream(conn, cur)    # MySQL直接关闭连接让连接池丢弃它，而不是把剩余结果全部读完
+            stmt.record(rows, time.perf_counter() - start)
+
+# execute()和select()不同的是，cursor对象不返回结果集，而通过rowcount返回结果数
+# 在orm.transaction()中执行时，由外层事务统一提交，autocommit参数不起作用
+async def execute(sql, args, autocommit=True, timeout=None):
+    stmt = get_statement(sql)
+    log(sql, args)
+    start = time.perf_counter()
+    if in_transaction():
+        autocommit = True
+    try:
+        async with _statement_connection() as conn:    # 用完的连接归还连接池，不再关闭
+            if not autocommit:
+                await conn.begin()
+            try:
+                affected = await _run_query(conn, _write(conn, stmt.driver_sql, args), _query_timeout(timeout), sql)
+                if not autocommit:    # 为什么每执行一次都要检测autocommit?
+                    await conn.commit()
+            except BaseException as e:
+                if not autocommit and not conn.closed:    # 超时后被丢弃的连接无法回滚，服务端会在断开时回滚
+                    await conn.rollback()    # 如果执行失败，则回滚
+                raise    # 收集异常，但不处理
+            finally:
+                _wrote()    # 失败的写也可能已经修改了数据
+    except QueryTimeoutError:
+        _record_timeout(stmt, args, start)
+        raise
+    _stick_to_primary()    # 之后一段时间的读走主库，避免副本延迟导致读不到刚写的数据
+    elapsed = time.perf_counter() - start
+    stmt.record(affected, elapsed)
+    _check_slow(stmt, args, affected, elapsed)
+    return affected
+
+
+async def _write(conn, sql, args):
+    async with _backend.cursor(conn) as cur:
+        await cur.execute(sql, args)
+        return cur.rowcount    # Returns the number of rows that has been produced of affected.
 
 
 def create_args_string(num):
@@ -78,23 +708,51 @@ def create_args_string(num):
     return ', '.join(L)
 
 
+def create_values_string(num, rows):
+    ' build the values list of a multi-row insert: (?, ?), (?, ?), ... '
+    return ', '.join(['(%s)' % create_args_string(num)] * rows)
+
+
+def create_in_args(values):
+    '''
+    Build the placeholders of an "in (...)" list. The values are padded by repeating the last one
+    up to a power of two, so that in-queries only come in a few shapes for the statement cache.
+
+    >>> create_in_args(['a', 'b', 'c'])
+    ('?, ?, ?, ?', ['a', 'b', 'c', 'c'])
+    '''
+    values = list(values)
+    n = 1
+    while n < len(values):
+        n = n * 2
+    return create_args_string(n), values + values[-1:] * (n - len(values))
+
+
 # 创建MySQL中集中常用的数据类型
 class Field(object):
 
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, defer=False, index=False, unique=False, references=None):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.defer = defer    # 延迟加载的列不出现在findAll的默认查询中
+        self.index = index or unique    # 为该列建立单列索引
+        self.unique = unique
+        self.references = references    # 外键引用的模型名(类名或表名)，例如blog_id引用'Blog'，用于prefetch
 
     def __str__(self):
         return '<%s, %s: %s>' % (self.__class__.__name__, self.column_type, self.name)    # 返回对于自身的描述
 
+    def convert(self, value):
+        ' convert a value from the outside (e.g. a url path) to the python type of the column. '
+        return value
+
 
 class StringField(Field):
 
-    def __init__(self, name=None, primary_key=None, default=None, ddl='varchar(100)'):
-        super().__init__(name, ddl, primary_key, default)
+    def __init__(self, name=None, primary_key=None, default=None, ddl='varchar(100)', index=False, unique=False, references=None):
+        super().__init__(name, ddl, primary_key, default, index=index, unique=unique, references=references)
 
 
 class BooleanField(Field):
@@ -105,20 +763,377 @@ class BooleanField(Field):
 
 class IntegerField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'bigint', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, index=False, unique=False, references=None):
+        super().__init__(name, 'bigint', primary_key, default, index=index, unique=unique, references=references)
+
+    def convert(self, value):
+        return int(value)
 
 
 class FloatField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0.0):
-        super().__init__(name, 'real', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False):
+        super().__init__(name, 'real', primary_key, default, index=index)
 
 
 class TextField(Field):
 
-    def __init__(self, name=None, default=None):
-        super().__init__(name,'text', False, default)
+    def __init__(self, name=None, default=None, defer=False, ddl='text'):
+        super().__init__(name, ddl, False, default, defer)
+
+
+# 模型的二级索引声明，用法：
+# class Comment(Model):
+#     __indexes__ = [('blog_id', 'created_at')]    # 列名的tuple，或者单个列名，或者Index
+#     created_at = FloatField(default=time.time, index=True)    # 单列索引也可以在Field上声明
+class Index(object):
+
+    def __init__(self, *columns, name=None, unique=False):
+        if not columns:
+            raise ValueError('Index needs at least one column.')
+        self.columns = columns
+        self.name = name or 'idx_%s' % '_'.join(columns)    # 与schema.sql的命名一致：idx_列名
+        self.unique = unique
+
+    def __str__(self):
+        return '<Index %s (%s)%s>' % (self.name, ', '.join(self.columns), ' unique' if self.unique else '')
+
+
+# 按类名或表名查找模型，外键引用的模型可以在引用它的模型之后定义，所以在使用时才查找
+def _model_named(name):
+    model = _models.get(name)
+    if model is None:
+        for m in _models.values():
+            if m.__name__ == name:
+                return m
+        raise RuntimeError('Unknown model: %s' % name)
+    return model
+
+
+# 主键缓存中用来表示"数据库中不存在该记录"的标记，用于负缓存
+_NOT_FOUND = object()
+
+# 所有的Model，表名 -> Model
+_models = dict()
+
+# 每次in查询最多包含的主键数
+_MAX_IN = 500
+
+
+class Loader(object):
+    '''
+    Coalesces the find() calls of one model made in the same event loop tick into one
+    "where pk in (...)" query, and hands each caller its row.
+    '''
+
+    def __init__(self, model, loop):
+        self.model = model
+        self.loop = loop
+        self.batch = None    # 本轮正在收集主键的批次
+        self.batches = 0
+        self.loads = 0
+
+    async def load(self, pk, timeout=None):
+        ' wait for the row of pk, loaded together with the other pks requested in this tick. '
+        batch = self.batch
+        if batch is None or batch.cancelled:    # 本轮的第一个请求，当前已就绪的回调都执行完之后再统一查询
+            batch = self.batch = _Batch()
+            self.loop.call_soon(self._dispatch, batch, context=contextvars.Context())    # 不继承调用者的事务等上下文
+        fut = batch.pending.get(pk)
+        if fut is None:
+            fut = batch.pending[pk] = self.loop.create_future()
+        self.loads += 1
+        batch.waiters += 1
+        try:
+            return await _wait_shared(fut, timeout)    # 一个调用者被取消不影响共享同一批次的其他调用者
+        finally:
+            batch.waiters -= 1
+            if not batch.waiters:    # 没有调用者在等待这个批次了，终止查询(或者不再发起查询)
+                batch.cancel()
+
+    def _dispatch(self, batch):
+        if self.batch is batch:
+            self.batch = None
+        if batch.cancelled:
+            return
+        self.batches += 1
+        batch.task = self.loop.create_task(self._run(batch.pending))
+
+    async def _run(self, pending):
+        try:
+            rows = await self.model._find_rows(list(pending.keys()))
+        except Exception as e:
+            for fut in pending.values():
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        except BaseException:
+            for fut in pending.values():
+                fut.cancel()
+            raise
+        for pk, fut in pending.items():
+            if not fut.done():
+                fut.set_result(rows.get(pk))
+
+
+class _Batch(object):
+
+    __slots__ = ('pending', 'waiters', 'task', 'cancelled')
+
+    def __init__(self):
+        self.pending = dict()    # pk -> future，同一个主键的调用者共享一个future
+        self.waiters = 0
+        self.task = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        if self.task is not None:
+            self.task.cancel()
+        for fut in self.pending.values():
+            fut.cancel()
+
+
+_loaders = weakref.WeakKeyDictionary()    # 每个event loop各自的Loader：loop -> {model: Loader}
+
+
+def _loader(model):
+    loop = asyncio.get_running_loop()
+    loaders = _loaders.get(loop)
+    if loaders is None:
+        loaders = _loaders[loop] = dict()
+    loader = loaders.get(model)
+    if loader is None:
+        loader = loaders[model] = Loader(model, loop)
+    return loader
+
+
+# 紧凑的行对象：元类为每个Model生成一个Row子类，列保存在__slots__中，没有每行一个dict的开销，
+# 属性访问是直接的slot读取。用于只读的大列表，例如findAll(..., compact=True)
+class Row(object):
+    '''
+    Base class of the compact row classes generated for each model. Supports attribute access,
+    the read-only dict API (row['name'], get, keys, items, ...) and to_dict() for JSON export.
+    '''
+
+    __slots__ = ()
+    __columns__ = ()
+    __model__ = None
+
+    @classmethod
+    def from_dict(cls, d):
+        row = cls.__new__(cls)
+        for k, v in d.items():
+            setattr(row, k, v)
+        return row
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__columns__ and hasattr(self, key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return [k for k in self.__columns__ if hasattr(self, k)]    # 未加载的列(延迟或投影)不出现
+
+    def values(self):
+        return [getattr(self, k) for k in self.keys()]
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.keys()]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def keyset(self):
+        return tuple(getattr(self, k, None) for k in self.__model__.__keyset__)
+
+    def model(self):
+        ' convert to a full Model instance, e.g. before update(). '
+        return self.__model__._from_row(self.to_dict())
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.to_dict())
+
+    __str__ = __repr__
+
+
+# Query.where()的条件：column__op=value
+_OPERATORS = {'eq': '=', 'ne': '<>', 'lt': '<', 'lte': '<=', 'gt': '>', 'gte': '>=', 'like': 'like', 'in': 'in'}
+
+# 每个模型最多缓存的查询形状数
+_MAX_PLANS = 1000
+
+
+def _condition_key(condition):
+    return condition[0], condition[1]
+
+
+# 可组合的查询：只记录条件，执行时按查询的"形状"(列、运算符、排序，不含参数值)查找编译好的sql，
+# 形状相同的查询共用同一条sql，语句统计和结果缓存的键也因此稳定
+class Query(object):
+    '''
+    Composable select of one model, e.g.
+
+        blogs = await Blog.query().where(user_id=uid).order_by('-created_at').limit(10).all()
+
+    Conditions are column=value or column__op=value (op: ne, lt, lte, gt, gte, like, in;
+    None compares with is null), joined with and; where('`a`>? or `b`<?', x, y) adds a raw
+    fragment. The SQL is compiled and checked once per query shape and cached on the model,
+    values are always passed as parameters. Methods change the query in place and return it.
+    '''
+
+    __slots__ = ('_model', '_conditions', '_raw', '_raw_args', '_order', '_limit', '_offset', '_columns', '_compact', '_prefetch', '_timeout')
+
+    def __init__(self, model):
+        self._model = model
+        self._conditions = []    # (列, 运算符, 值)
+        self._raw = ()
+        self._raw_args = ()
+        self._order = ()
+        self._limit = None
+        self._offset = None
+        self._columns = None
+        self._compact = False
+        self._prefetch = ()
+        self._timeout = None
+
+    def where(self, *raw, **conditions):
+        if raw:
+            self._raw = self._raw + raw[:1]
+            self._raw_args = self._raw_args + raw[1:]
+        for k, v in conditions.items():
+            column, _, op = k.partition('__')
+            self._conditions.append((column, op or 'eq', v))
+        return self
+
+    def order_by(self, *columns):
+        ' columns to sort by, a leading - sorts in descending order. '
+        self._order = self._order + columns
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def offset(self, offset):
+        self._offset = offset
+        return self
+
+    def columns(self, *columns):
+        ' select only these columns (the primary key is always included), see findAll(columns=...). '
+        self._columns = columns
+        return self
+
+    def compact(self, compact=True):
+        ' return read-only compact rows instead of Model instances. '
+        self._compact = compact
+        return self
+
+    def prefetch(self, *relations):
+        self._prefetch = self._prefetch + relations
+        return self
+
+    def timeout(self, seconds):
+        self._timeout = seconds
+        return self
+
+    async def all(self):
+        sql, args = self._plan(False)
+        rs = await self._model._select(sql, args, timeout=self._timeout)
+        return await self._model._objects(rs, self._compact, self._prefetch, self._timeout)
+
+    async def first(self):
+        self._limit = 1
+        rs = await self.all()
+        return rs[0] if rs else None
+
+    async def count(self):
+        ' count the matching rows, ordering and limit are ignored. '
+        sql, args = self._plan(True)
+        rs = await self._model._select(sql, args, 1, self._timeout)
+        return rs[0]['_num_'] if rs else 0
+
+    # 返回编译好的sql和本次的参数；条件按列名排序，书写顺序不同的同一查询得到相同的sql
+    def _plan(self, count):
+        conditions = sorted(self._conditions, key=_condition_key) if len(self._conditions) > 1 else self._conditions
+        shape = []
+        args = []
+        for column, op, value in conditions:
+            if op == 'in':
+                value = list(value)
+                if value:
+                    value = create_in_args(value)[1]    # 参数个数补齐到2的幂，限制不同形状的数量
+                    args.extend(value)
+                shape.append((column, op, len(value)))
+            elif value is None and op in ('eq', 'ne'):
+                shape.append((column, 'null' if op == 'eq' else 'notnull', 0))
+            else:
+                shape.append((column, op, 1))
+                args.append(value)
+        args.extend(self._raw_args)
+        if count:
+            key = (True, tuple(shape), self._raw)
+        else:
+            key = (False, tuple(shape), self._raw, self._order, self._limit is not None, self._offset is not None, self._columns)
+            if self._limit is not None:
+                args.append(self._limit)
+            if self._offset is not None:
+                args.append(self._offset)
+        plans = self._model.__plans__
+        sql = plans.get(key)
+        if sql is None:
+            sql = self._compile(*key)
+            if len(plans) < _MAX_PLANS:
+                plans[key] = sql
+        return sql, args
+
+    def _compile(self, count, shape, raw, order=(), limit=False, offset=False, columns=None):
+        model = self._model
+        if count:
+            sql = ['select count(`%s`) _num_ from `%s`' % (model.__primary_key__, model.__table__)]
+        else:
+            sql = [model._select_sql(columns) if columns else model.__select_list__]
+        clauses = []
+        for column, op, n in shape:
+            model._column(column)
+            if op == 'null':
+                clauses.append('`%s` is null' % column)
+            elif op == 'notnull':
+                clauses.append('`%s` is not null' % column)
+            elif op not in _OPERATORS:
+                raise ValueError('Invalid operator: %s__%s' % (column, op))
+            elif op == 'in':
+                clauses.append('`%s` in (%s)' % (column, create_args_string(n)) if n else '1=0')    # 空列表什么也不匹配
+            else:
+                clauses.append('`%s` %s ?' % (column, _OPERATORS[op]))
+        clauses.extend(map(lambda r: '(%s)' % r, raw))
+        if clauses:
+            sql.append('where %s' % ' and '.join(clauses))
+        if order:
+            sql.append('order by %s' % ', '.join(map(lambda c: '`%s` desc' % model._column(c[1:]) if c.startswith('-') else '`%s`' % model._column(c), order)))
+        if offset and not limit:
+            raise ValueError('offset() needs limit().')
+        if limit:
+            sql.append('limit ?')
+        if offset:
+            sql.append('offset ?')
+        return ' '.join(sql)
 
 
 # 元类在此处的作用是修改类属性，还可以用来修改类方法，还可用来添加类属性和类方法
@@ -130,13 +1145,13 @@ class ModelMetaclass(type):    # ModelMetaclass是继承了type 的一个元类
         if name=='Model':
             return type.__new__(cls, name, bases, attrs)    # 如果类名为Model, 则用type实例化，下文中Model在此创建，attrs是一个dict
         tableName = attrs.get('__table__', None) or name    # 表名有类中的__table__定义，如果没有定义，则和类名相同
-        logging.info('found model: %s (table: %s)' % (name, tableName))
+        logging.info('found model: %s (table: %s)', name, tableName)
         mappings = dict()
         fields = []
         primaryKey = None
         for k, v in attrs.items():
             if isinstance(v, Field):
-                logging.info('   found mapping: %s ==> %s' % (k, v))
+                logging.debug('   found mapping: %s ==> %s', k, v)
                 mappings[k] = v
                 if v.primary_key:
                     # 找到主键
@@ -155,10 +1170,80 @@ class ModelMetaclass(type):    # ModelMetaclass是继承了type 的一个元类
         attrs['__primary_key__'] = primaryKey    # 主键属性名
         attrs['__fields__'] = fields   # 除主键外的属性名
         attrs['__select__'] = 'select `%s` , %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
+        deferred = [f for f in fields if mappings[f].defer]    # 延迟加载的大字段，例如博客的content
+        attrs['__deferred__'] = deferred
+        attrs['__select_list__'] = 'select `%s` , %s from `%s`' % (primaryKey, ', '.join(map(lambda f: ' %s ' % f, [f for f in fields if f not in deferred])), tableName) if deferred else attrs['__select__']    # findAll默认使用的查询，不包含延迟加载的列
+        attrs['__selects__'] = dict()    # 按列投影生成的select语句缓存
+        attrs['__updates__'] = dict()    # 按列集合生成的update语句缓存
+        attrs['__plans__'] = dict()    # Query按形状编译的select语句缓存
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
+        attrs['__insert_many__'] = 'insert into `%s` (%s, `%s`) values' % (tableName, ', '.join(escaped_fields), primaryKey)    # 多行插入的前缀，列顺序与__insert__一致
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s` = ?' % (mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)    # 这是元类的实例化是通过复写type的__new__()方法实现的，name在下文中就是指Model，bases是指当通过Model形成派生类时，Model就是bases
+        attrs['__batch__'] = attrs.get('__batch__', False)    # 是否把同一轮事件循环中的find()合并成一次in查询
+        keyset = attrs.get('__keyset__', None) or (('created_at', primaryKey) if 'created_at' in mappings else (primaryKey,))    # 键集分页使用的排序列，最后一列须唯一
+        keyset_columns = ', '.join(map(lambda f: '`%s`' % f, keyset))
+        attrs['__keyset__'] = tuple(keyset)
+        attrs['__seek_after__'] = '(%s) < (%s)' % (keyset_columns, create_args_string(len(keyset)))    # 下一页：比游标"更旧"的记录
+        attrs['__seek_before__'] = '(%s) > (%s)' % (keyset_columns, create_args_string(len(keyset)))    # 上一页：比游标"更新"的记录
+        attrs['__keyset_desc__'] = ', '.join(map(lambda f: '`%s` desc' % f, keyset))
+        attrs['__keyset_asc__'] = ', '.join(map(lambda f: '`%s` asc' % f, keyset))
+        cache = attrs.get('__cache__', None)    # 可选的主键缓存，例如 __cache__ = dict(ttl=60, maxsize=1000, negative_ttl=5)
+        if cache:
+            cache = dict(ttl=cache.get('ttl', 60), maxsize=cache.get('maxsize', 1000), negative_ttl=cache.get('negative_ttl', 5))
+            attrs['__cache__'] = cache
+            attrs['__pk_cache__'] = LRUCache(maxsize=cache['maxsize'], ttl=cache['ttl'])
+        else:
+            attrs['__cache__'] = None
+            attrs['__pk_cache__'] = None
+        counter = attrs.get('__counter__', None)    # 可选的行数计数器，例如 __counter__ = dict(ttl=300, keys=('blog_id',))
+        if counter:
+            counter = dict(ttl=counter.get('ttl', 300), keys=tuple(counter.get('keys', ())))
+            attrs['__counter__'] = counter
+            attrs['__row_counter__'] = RowCounter(ttl=counter['ttl'])
+        else:
+            attrs['__counter__'] = None
+            attrs['__row_counter__'] = None
+        query_cache = attrs.get('__query_cache__', None)    # 可选的查询结果缓存，例如 __query_cache__ = dict(ttl=60, maxsize=500)
+        if query_cache:
+            query_cache = dict(ttl=query_cache.get('ttl', 60), maxsize=query_cache.get('maxsize', 500))
+            attrs['__query_cache__'] = query_cache
+            attrs['__result_cache__'] = LRUCache(maxsize=query_cache['maxsize'], ttl=query_cache['ttl'])
+        else:
+            attrs['__query_cache__'] = None
+            attrs['__result_cache__'] = None
+        attrs['__generation__'] = 0    # 表的版本号，每次写操作递增，旧版本的查询结果不会再被命中
+        attrs['__unsettled_until__'] = 0.0    # 写操作之后副本可能还没有同步的时间，之前从副本读到的结果不写入缓存
+        indexes = [Index(k, unique=mappings[k].unique) for k in [primaryKey] + fields if mappings[k].index and not mappings[k].primary_key]
+        for index in attrs.get('__indexes__', None) or ():
+            if isinstance(index, str):
+                index = Index(index)
+            elif not isinstance(index, Index):
+                index = Index(*index)
+            indexes.append(index)
+        for index in indexes:
+            for c in index.columns:
+                if c not in mappings:
+                    raise RuntimeError('Unknown column in index %s: %s' % (index.name, c))
+        attrs['__indexes__'] = [(index.name, list(index.columns), index.unique) for index in indexes]    # 与Backend.table_indexes()的格式相同
+        relations = dict()    # 关系名 -> (外键列, 引用的模型名)，关系名是外键列去掉_id，例如blog_id -> blog
+        for k in fields:
+            target = mappings[k].references
+            if target is None:
+                continue
+            if not k.endswith('_id'):
+                raise RuntimeError('Foreign key column must be named <relation>_id: %s' % k)
+            relation = k[:-3]
+            if relation in mappings or any(hasattr(b, relation) for b in bases):
+                raise RuntimeError('Relation %s of %s conflicts with an existing attribute.' % (relation, name))
+            relations[relation] = (k, target)
+        attrs['__relations__'] = relations
+        columns = tuple([primaryKey] + fields)
+        attrs['__row__'] = type('%sRow' % name, (Row,), dict(__slots__=columns + tuple(relations), __columns__=columns))    # 该模型的紧凑行类，关系也有slot
+        model = type.__new__(cls, name, bases, attrs)
+        model.__row__.__model__ = model
+        _models[tableName] = model
+        return model    # 这是元类的实例化是通过复写type的__new__()方法实现的，name在下文中就是指Model，bases是指当通过Model形成派生类时，Model就是bases
 
 
 # 注意Model类本身并没有修改attrs属性，但是由Model类派生的子类却可以通过metaclass实现attrs属性。
@@ -166,42 +1251,98 @@ class ModelMetaclass(type):    # ModelMetaclass是继承了type 的一个元类
 # Model类的类方法和实例方法都可以被子类继承
 class Model(dict, metaclass=ModelMetaclass):
 
+    _dirty = None    # 从数据库加载的实例上是自加载以来被修改过的列的集合，新建的实例不跟踪(None)
+
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
 
+    # 由数据库中的一行构造实例，开始跟踪修改过的列，update()只写这些列
+    @classmethod
+    def _from_row(cls, r):
+        obj = cls(**r)
+        object.__setattr__(obj, '_dirty', set())    # 内部状态保存在实例属性中，不放进dict，不会被序列化
+        return obj
+
+    def __setitem__(self, key, value):
+        dirty = self._dirty
+        if dirty is not None and key in self.__mappings__ and (key not in self or self[key] != value):    # 赋相同的值不算修改
+            dirty.add(key)
+        super(Model, self).__setitem__(key, value)
+
+    def dirty_fields(self):
+        ' return the names of columns changed since the object was loaded (all columns for a new object). '
+        if self._dirty is None:
+            return list(self.__fields__)
+        return [f for f in self.__fields__ if f in self._dirty]
+
     def __getattr__(self, key):
         try:
             return self[key]
         except KeyError:
+            if key in self.__deferred__:
+                raise AttributeError(r"deferred column '%s' is not loaded, use %s.undefer() first" % (key, self.__class__.__name__))
+            if key in self.__relations__:
+                raise AttributeError(r"relation '%s' is not loaded, use %s.prefetch() first" % (key, self.__class__.__name__))
             raise AttributeError(r"'Model' object has no attribute '%s'" % key)
 
     def __setattr__(self, key, value):
         self[key] = value
 
+    def keyset(self):
+        ' return the keyset pagination key of this object, e.g. (created_at, id). '
+        return tuple(map(self.getValue, self.__keyset__))
+
     def getValue(self, key):
-        return getattr(self, key, None)
+        return self.get(key)    # 直接查dict，不经过__getattr__抛出再捕获异常
 
     def getValueOrDefault(self, key):
-        value = getattr(self, key, None)
+        value = self.get(key)
         if value is None:
             field = self.__mappings__[key]     # 如果实例属性中未找到该属性，则到类属性中去找默认值，由于类属性已移至__mappings__中，所有有了以下代码
             if field.default is not None:
                 value = field.default() if callable(field.default) else field.default    # primary_key 的值通过default获得
-                logging.debug('using default value for %s: %s' % (key, str(value)))
+                logging.debug('using default value for %s: %s', key, value)
                 setattr(self, key, value)
         return value
 
     # 根据where条件查找
     @classmethod
     async def findAll(cls, where=None, args=None, **kw):
-        ' find objects by where clause. '
-        sql = [cls.__select__]    # 获取sql查询语句
-        if where:
-            sql.append('where')    # 获取where条件
-            sql.append(where)
+        '''
+        find objects by where clause.
+
+        Pass compact=True to get read-only compact rows (see Row) instead of Model instances.
+
+        Pass after=key (or before=key) to page by keyset instead of offset: key is the
+        __keyset__ value of the last (or first) row of the current page, e.g. (created_at, id),
+        and None fetches the first page. Rows always come back newest first.
+
+        Pass timeout=seconds to bound the query (see orm.select()).
+
+        Pass prefetch=['blog', ...] to load related objects as well, see prefetch().
+        '''
+        columns = kw.get('columns', None)    # 只查询指定的列(主键总会包含)，默认不查询延迟加载的列
+        sql = [cls._select_sql(columns) if columns else cls.__select_list__]    # 获取sql查询语句
         if args is None:
             args = []
         orderBy = kw.get('orderBy', None)    # 获取orderby条件
+        reverse = False
+        if 'after' in kw or 'before' in kw:    # 键集(seek)分页：用索引范围扫描代替offset，深分页不再变慢
+            if orderBy:
+                raise ValueError('orderBy cannot be used with keyset pagination.')
+            backward = kw.get('before', None) is not None
+            key = kw['before'] if backward else kw.get('after', None)
+            if key is not None:
+                if len(key) != len(cls.__keyset__):
+                    raise ValueError('Invalid keyset value: %s' % str(key))
+                seek = cls.__seek_before__ if backward else cls.__seek_after__
+                where = '(%s) and %s' % (where, seek) if where else seek
+                args = list(args) + list(key)
+            orderBy = cls.__keyset_asc__ if backward else cls.__keyset_desc__
+            reverse = backward
+        if where:
+            sql.append('where')    # 获取where条件
+            sql.append(where)
         if orderBy:
             sql.append('order by')
             sql.append(orderBy)
@@ -216,49 +1357,392 @@ class Model(dict, metaclass=ModelMetaclass):
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)    # 调用select函数查找
-        return [cls(**r) for r in rs]    # 返回list of records, 由于findAll是类方法，所以使用model类对record进行construct
+        rs = await cls._select(' '.join(sql), args, timeout=kw.get('timeout', None))    # 调用select函数查找
+        if reverse:    # 向前翻页时按升序取出，再恢复为降序
+            rs = rs[::-1]
+        return await cls._objects(rs, kw.get('compact', False), kw.get('prefetch', None), kw.get('timeout', None))
+
+    # 由查询结果构造实例(或紧凑的行对象)，并加载需要的关系
+    @classmethod
+    async def _objects(cls, rs, compact=False, prefetch=None, timeout=None):
+        if compact:    # 只读的大列表使用紧凑的行对象
+            objs = [cls.__row__.from_dict(r) for r in rs]
+        else:
+            objs = [cls._from_row(r) for r in rs]    # 返回list of records, 由于findAll是类方法，所以使用model类对record进行construct
+        if prefetch:
+            await cls.prefetch(objs, *prefetch, timeout=timeout)
+        return objs
+
+    @classmethod
+    def query(cls):
+        ' start a composable query, see Query. '
+        return Query(cls)
+
+    @classmethod
+    def _column(cls, column):
+        if column not in cls.__mappings__:
+            raise ValueError('Invalid column: %s' % column)
+        return column
+
+    @classmethod
+    def _select_sql(cls, columns):
+        columns = tuple(columns)
+        sql = cls.__selects__.get(columns)
+        if sql is None:
+            for c in columns:
+                cls._column(c)
+            names = [cls.__primary_key__] + [c for c in columns if c != cls.__primary_key__]
+            sql = 'select %s from `%s`' % (', '.join(map(lambda f: '`%s`' % f, names)), cls.__table__)
+            cls.__selects__[columns] = sql
+        return sql
+
+    # 为一组实例批量加载延迟加载的列，只执行一次查询
+    @classmethod
+    async def undefer(cls, objs, *columns):
+        '''
+        load deferred (or projected-away) columns of objs in one batched query, e.g. await Blog.undefer(blogs).
+        '''
+        columns = columns or cls.__deferred__
+        pk = cls.__primary_key__
+        pending = dict()
+        for o in objs:
+            if any(c not in o for c in columns):
+                pending.setdefault(o.getValue(pk), []).append(o)
+        if not pending:
+            return
+        placeholders, args = create_in_args(pending.keys())
+        rs = await select('%s where `%s` in (%s)' % (cls._select_sql(columns), pk, placeholders), args)
+        for r in rs:
+            for o in pending.get(r[pk], ()):
+                for c in columns:
+                    dict.__setitem__(o, c, r[c])    # 加载的是数据库中的值，不是修改
+
+    # 为一组实例批量加载外键引用的对象，每个关系只执行一次in查询，避免逐个find()的N+1查询
+    @classmethod
+    async def prefetch(cls, objs, *relations, timeout=None):
+        '''
+        load related objects of objs (Model instances or compact rows) by their foreign keys,
+        one in query per relation, e.g. await Comment.prefetch(comments, 'blog', 'blog.user').
+        Like findAll(), related objects do not include deferred columns.
+
+        The related object (None if it does not exist) is set as an attribute, comment.blog,
+        not as a column, so it is not written by save() and not included in JSON output.
+        '''
+        nested = dict()    # 关系名 -> 嵌套的关系，例如'blog.user'在加载blog之后再为博客加载user
+        for path in relations:
+            relation, _, rest = path.partition('.')
+            if relation not in cls.__relations__:
+                raise ValueError('Unknown relation of %s: %s' % (cls.__name__, relation))
+            nested.setdefault(relation, [])
+            if rest:
+                nested[relation].append(rest)
+        for relation, rest in nested.items():
+            column, target = cls.__relations__[relation]
+            target = _model_named(target)
+            keys = list(dict.fromkeys(k for k in map(lambda o: o.get(column), objs) if k is not None))    # 去重并保持顺序
+            related = dict((k, target._from_row(r)) for k, r in (await target._find_related(keys, timeout)).items())
+            for o in objs:
+                object.__setattr__(o, relation, related.get(o.get(column)))    # Model的__setattr__会写入dict，这里设置为实例属性
+            if rest:
+                await target.prefetch([r for r in related.values() if r is not None], *rest, timeout=timeout)
+
+    @classmethod
+    async def stream(cls, where=None, args=None, chunk=1000, **kw):
+        '''
+        iterate objects by where clause without loading the whole result set:
+        async for c in Comment.stream('blog_id=?', [id], chunk=1000): ...
+        '''
+        sql = [cls.__select__]
+        if where:
+            sql.append('where')
+            sql.append(where)
+        orderBy = kw.get('orderBy', None)
+        if orderBy:
+            sql.append('order by')
+            sql.append(orderBy)
+        rs = stream(' '.join(sql), args, chunk)
+        try:
+            async for r in rs:
+                yield cls._from_row(r)
+        finally:
+            await rs.aclose()    # 提前停止时同时关闭底层的流式查询，释放连接
 
     @classmethod
-    async def findNumber(cls, selectField, where=None, args=None):
+    async def findNumber(cls, selectField, where=None, args=None, timeout=None):
         ' find number by select and where. '
         sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
         if where:
             sql.append('where')    # 获取where条件
             sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
+        rs = await cls._select(' '.join(sql), args, 1, timeout)
         if len(rs) == 0:
             return None
         return rs[0]['_num_']    # 返回找到记录的行数
 
+    # 执行findAll/findNumber的查询，模型声明了__query_cache__时先查结果缓存
+    @classmethod
+    async def _select(cls, sql, args, size=None, timeout=None):
+        cache = cls.__result_cache__
+        if cache is None or in_transaction():    # 事务中可能读到自己未提交的修改，不使用缓存
+            return await select(sql, args, size, timeout=timeout)
+        generation = cls.__generation__
+        key = (generation, sql, tuple(args or ()), size)
+        rs = cache.get(key) if not _reads_primary() else None    # 刚写过数据的请求不读缓存，缓存中可能是副本上的旧结果
+        if rs is None:
+            cacheable = _cacheable_read(cls)    # 表刚被修改时副本上的结果不缓存
+            rs = await select(sql, args, size, timeout=timeout)
+            if cacheable and cls.__generation__ == generation:    # 查询期间表被修改过，结果可能是修改之前的，不缓存
+                cache.set(key, rs)
+        return rs
+
     # 根据主键查找
     @classmethod
-    async def find(cls, pk):
+    async def find(cls, pk, timeout=None):
         ' find object by primary key. '
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
-        if len(rs) == 0:
+        pk = cls._pk(pk)
+        if pk is _NOT_FOUND:
+            return None
+        cache = cls.__pk_cache__
+        if cache is not None and not _reads_primary():    # 刚写过数据的请求不读缓存，缓存中可能是副本上的旧记录
+            r = cache.get(pk)
+            if r is _NOT_FOUND:    # 最近查过且不存在，不再访问数据库
+                return None
+            if r is not None:
+                return cls._from_row(r)    # 每次返回新的实例，调用者修改实例不会影响缓存
+        if cls.__batch__ and not in_transaction() and not _reads_primary():    # 与同时发生的find()合并查询
+            r = await _loader(cls).load(pk, timeout)
+        else:
+            r = (await cls._find_rows([pk], timeout)).get(pk)
+        if r is None:
+            return None
+        return cls._from_row(r)    # 返回找到的记录
+
+    # 根据一组主键查找，只执行一次in查询
+    @classmethod
+    async def find_many(cls, pks, timeout=None):
+        '''
+        find objects by a list of primary keys, returns a list aligned with pks (None if not found).
+        '''
+        pks = list(map(cls._pk, pks))
+        found = {_NOT_FOUND: None}
+        missing = []
+        cache = cls.__pk_cache__ if not _reads_primary() else None
+        for pk in pks:
+            if pk in found:
+                continue
+            r = cache.get(pk) if cache is not None else None
+            if r is None:
+                missing.append(pk)
+                found[pk] = None
+            else:
+                found[pk] = None if r is _NOT_FOUND else r
+        if missing:
+            found.update(await cls._find_rows(missing, timeout))
+        return [cls._from_row(found[pk]) if found[pk] is not None else None for pk in pks]
+
+    # 把主键转换成列的类型(例如url中的整数id)，主键缓存和查询结果都以此为键；无效的主键返回_NOT_FOUND
+    @classmethod
+    def _pk(cls, pk):
+        try:
+            return cls.__mappings__[cls.__primary_key__].convert(pk)
+        except (TypeError, ValueError):
+            return _NOT_FOUND
+
+    # 按主键读取prefetch引用的记录，与findAll一样不查询延迟加载的列：主键缓存中的完整记录去掉这些列后使用，
+    # 其余的用一次in查询读取(不写入主键缓存，缓存中应是完整的记录)，返回{pk: row}
+    @classmethod
+    async def _find_related(cls, pks, timeout=None):
+        cache = cls.__pk_cache__ if not _reads_primary() else None
+        deferred = cls.__deferred__
+        rows = dict()
+        missing = []
+        for k in pks:
+            r = cache.get(k) if cache is not None else None
+            if r is None:
+                missing.append(k)
+            elif r is not _NOT_FOUND:
+                rows[k] = dict((c, v) for c, v in r.items() if c not in deferred) if deferred else r
+        pk = cls.__primary_key__
+        for i in range(0, len(missing), _MAX_IN):
+            placeholders, args = create_in_args(missing[i:i + _MAX_IN])
+            for r in await select('%s where `%s` in (%s)' % (cls.__select_list__, pk, placeholders), args, timeout=timeout):
+                rows[r[pk]] = r
+        return rows
+
+    # 按主键读取记录并写入主键缓存，返回{pk: row}
+    @classmethod
+    async def _find_rows(cls, pks, timeout=None):
+        cache = cls.__pk_cache__
+        version = cache.version if cache is not None else None
+        cacheable = _cacheable_read(cls)    # 在查询开始时判断，之后才结束的同步窗口内读到的也可能是旧的
+        pk = cls.__primary_key__
+        rows = dict()
+        if len(pks) == 1:
+            rs = await select('%s where `%s`=?' % (cls.__select__, pk), pks, 1, timeout=timeout)
+            if rs:
+                rows[pks[0]] = rs[0]
+        else:
+            for i in range(0, len(pks), _MAX_IN):
+                placeholders, args = create_in_args(pks[i:i + _MAX_IN])
+                rs = await select('%s where `%s` in (%s)' % (cls.__select__, pk, placeholders), args, timeout=timeout)
+                for r in rs:
+                    rows[r[pk]] = r
+        if cache is not None and cacheable and cache.version == version and not in_transaction():    # 查询期间发生过失效，或者读到的可能是未提交的数据，则不写入缓存
+            for k in pks:
+                r = rows.get(k)
+                cache.set(k, r if r is not None else _NOT_FOUND, None if r is not None else cls.__cache__['negative_ttl'])
+        return rows
+
+    @classmethod
+    def cache_stats(cls):
+        ' return hit/miss/eviction counters of the primary key cache. '
+        if cls.__pk_cache__ is None:
             return None
-        return cls(**rs[0])    # 返回找到的第一条记录
+        return cls.__pk_cache__.stats()
+
+    @classmethod
+    def query_cache_stats(cls):
+        ' return hit/miss/eviction counters of the findAll/findNumber result cache. '
+        if cls.__result_cache__ is None:
+            return None
+        return cls.__result_cache__.stats()
+
+    # 返回行数，模型声明了__counter__时使用维护的计数，避免每次都count(id)
+    @classmethod
+    async def count(cls, **kw):
+        '''
+        count rows of the table, or rows where one column equals a value, e.g. Comment.count(blog_id=id).
+        '''
+        if len(kw) > 1:
+            raise ValueError('count() accepts at most one filter column.')
+        key = None
+        where = None
+        args = None
+        if kw:
+            key = next(iter(kw.items()))
+            if key[0] not in cls.__mappings__:
+                raise ValueError('Invalid count column: %s' % key[0])
+            where = '`%s`=?' % key[0]
+            args = [key[1]]
+        counter = cls.__row_counter__
+        if counter is None or (key is not None and key[0] not in cls.__counter__['keys']):
+            return await cls.findNumber('count(`%s`)' % cls.__primary_key__, where, args)
+        num = counter.get(key)
+        if num is None:    # 第一次使用或已到对账时间，执行真实的count
+            version = counter.version
+            num = await cls.findNumber('count(`%s`)' % cls.__primary_key__, where, args)
+            if counter.version == version and not in_transaction():    # count期间有写操作或在事务中则不保存结果
+                counter.set(key, num)
+        return num
+
+    # 写操作之后增减维护的计数
+    def _count_rows(self, delta):
+        counter = self.__row_counter__
+        if counter is not None:
+            counter.add(None, delta)
+            for k in self.__counter__['keys']:
+                counter.add((k, self.getValue(k)), delta)
+
+    # 写操作之后使主键缓存中的记录失效(包括负缓存)，并使表上缓存的查询结果全部失效
+    @classmethod
+    def _invalidate(cls, pk):
+        if cls.__pk_cache__ is not None:
+            cls.__pk_cache__.pop(pk)
+        cls.__generation__ += 1
+        _unsettle(cls)
+        tx = _transaction.get()
+        if tx is not None:
+            tx.touch(cls, pk)
 
     # 插入一条记录
     async def save(self):
         args = list(map(self.getValueOrDefault, self.__fields__))    # 将除主键以外的属性组成List
         args.append(self.getValueOrDefault(self.__primary_key__))    # 将主键属性也添加进去, 此处为什么没有__primary_key__=id?
-        logging.info('The problem is '+str(args))
         rows = await execute(self.__insert__, args)
+        object.__setattr__(self, '_dirty', set())    # 之后的update()只写修改过的列
+        self._invalidate(args[-1])
+        self._count_rows(rows)
         if rows != 1:
-            logging.warn('failed to insert record: affected rows: %s' % rows)
+            logging.warning('failed to insert record: affected rows: %s', rows)
+
+    # 批量插入记录，每批生成一条多行insert语句并在一个事务中执行
+    @classmethod
+    async def save_many(cls, instances, batch_size=100):
+        ' insert instances using one multi-row insert and one transaction per batch. '
+        instances = list(instances)
+        num = len(cls.__fields__) + 1
+        rows = 0
+        for i in range(0, len(instances), batch_size):
+            batch = instances[i:i + batch_size]
+            args = []
+            for obj in batch:    # 列顺序与__insert__相同：先非主键属性，最后是主键
+                args.extend(map(obj.getValueOrDefault, cls.__fields__))
+                args.append(obj.getValueOrDefault(cls.__primary_key__))
+            sql = '%s %s' % (cls.__insert_many__, create_values_string(num, len(batch)))    # 满批次的SQL相同，可以命中语句缓存
+            rows += await execute(sql, args, autocommit=False)
+            for obj in batch:
+                object.__setattr__(obj, '_dirty', set())
+                cls._invalidate(obj.getValue(cls.__primary_key__))
+                obj._count_rows(1)
+        if rows != len(instances):
+            logging.warning('failed to insert records: affected rows: %s, expected: %s', rows, len(instances))
+        return rows
 
     # 更新记录，更新数据是指对表中存在的记录进行修改
+    # 从数据库加载(或已保存)的实例只更新修改过的列，没有修改时不访问数据库
     async def update(self):
-        args = list(map(self.getValue, self.__fields__))
+        if self._dirty is not None:
+            fields = self.dirty_fields()
+            if not fields:
+                return
+            sql = self._update_sql(fields)    # 按列集合缓存的update语句
+        else:
+            fields = self.__fields__
+            sql = self.__update__
+            if self.__deferred__ and any(f not in self for f in self.__deferred__):    # 未加载的延迟列不能被写成NULL
+                fields = [f for f in fields if f in self or f not in self.__deferred__]
+                sql = self._update_sql(fields)
+        args = list(map(self.getValue, fields))
         args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        rows = await execute(sql, args)
+        if self._dirty is not None:
+            self._dirty.clear()
+        self._invalidate(args[-1])
+        if self.__row_counter__ is not None:
+            for k in self.__counter__['keys']:    # 无法知道过滤列的旧值，只丢弃新值对应的计数，旧值的计数在对账时修正
+                if k in fields:
+                    self.__row_counter__.pop((k, self.getValue(k)))
         if rows != 1:
-            logging.warn('failed to update by primary key: affected rows: %s' % rows)
+            logging.warning('failed to update by primary key: affected rows: %s', rows)
+
+    @classmethod
+    def _update_sql(cls, fields):
+        fields = tuple(fields)
+        sql = cls.__updates__.get(fields)
+        if sql is None:
+            sql = 'update `%s` set %s where `%s`=?' % (cls.__table__, ', '.join(map(lambda f: '`%s` = ?' % (cls.__mappings__.get(f).name or f), fields)), cls.__primary_key__)
+            cls.__updates__[fields] = sql
+        return sql
+
+    # 用SQL表达式修改一条记录，例如计数器的原子加减：await Blog.update_columns(id, '`comment_count`=`comment_count`+?', [1])
+    @classmethod
+    async def update_columns(cls, pk, assignments, args=()):
+        ' update one row with raw "set" assignments, returns the affected rows. '
+        rows = await execute('update `%s` set %s where `%s`=?' % (cls.__table__, assignments, cls.__primary_key__), list(args) + [pk])
+        cls._invalidate(pk)
+        return rows
+
+    # 绕过ORM直接修改了表之后调用，使主键缓存和查询结果缓存失效
+    @classmethod
+    def invalidate(cls, *pks):
+        for pk in pks:
+            cls._invalidate(pk)
+        cls.__generation__ += 1
 
     async def remove(self):
         args = [self.getValueOrDefault(self.__primary_key__)]    # 必须在一个loop里面save和remove
         rows = await execute(self.__delete__, args)
+        self._invalidate(args[0])
+        self._count_rows(-rows)
         if rows != 1:
-            logging.warn('failed to update by primary key: affected rows: %s' % rows)
+            logging.warning('failed to update by primary key: affected rows: %s', rows)
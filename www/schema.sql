@@ -22,7 +22,7 @@ create table users(
 	) engine=innodb default charset=utf8;
 	
 create table blogs(
-    `id` varchar(50) not null,
+    `id` bigint not null,
 	`user_id` varchar(50) not null,
 	`user_name` varchar(50) not null,
 	`user_image` varchar(500) not null,
@@ -30,18 +30,21 @@ create table blogs(
 	`summary` varchar(200) not null,
 	`content` mediumtext not null,
 	`created_at` real not null,
+	`comment_count` bigint not null default 0,
+	`last_comment_at` real not null default 0,
 	key `idx_created_at` (`created_at`),
 	primary key(`id`)
 ) engine=innodb default charset=utf8;
 
 create table comments(
-    `id` varchar(50) not null,
-	`blog_id` varchar(50) not null,
+    `id` bigint not null,
+	`blog_id` bigint not null,
 	`user_id` varchar(50) not null,
 	`user_name` varchar(50) not null,
 	`user_image` varchar(500) not null,
 	`content` mediumtext not null,
 	`created_at` real not null,
 	key `idx_created_at` (`created_at`),
+	key `idx_blog_id_created_at` (`blog_id`, `created_at`),
 	primary key (`id`)
 ) engine=innodb default charset=utf8;
\ No newline at end of file
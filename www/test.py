@@ -1,15 +1,147 @@
 import orm
-import asyncio
+import asyncio, time
+from apis import CursorPage
 from models import User, Blog, Comment
 
+# 使用内存中的SQLite数据库，不需要MySQL服务器
 async def test(loop):
-    await orm.create_pool(loop=loop, user='www-data', password='www-data',  db='awesome')
+    await orm.create_pool(loop=loop, backend='sqlite', path=':memory:')
+    try:
+        await orm.create_tables()
+        u = User(name='Test', email='test@example.com', passwd='1234567890', image='about:blank')
 
-    u = User(name='Test', email='test@example.com', passwd='1234567890', image='about:blank')
+        await u.save()
+        assert (await User.find(u.id)).email == 'test@example.com'
+        await u.remove()
+        assert await User.find(u.id) is None
+        print('save/remove ok')
+    finally:
+        await orm.close_pool()
 
-    await u.save()
-    await u.remove()
+async def sqlite_pool(**kw):
+    await orm.create_pool(None, backend='sqlite', path=':memory:', **kw)
+    await orm.create_tables()
+
+def new_blog(name, **kw):
+    return Blog(user_id='u', user_name='n', user_image='i', name=name, summary='s', content='c', **kw)
+
+# 事务：正常退出时提交，异常时回滚，嵌套的事务(SAVEPOINT)只回滚内层的修改
+async def test_transactions():
+    await sqlite_pool()
+    try:
+        async with orm.transaction():
+            await new_blog('committed').save()
+        try:
+            async with orm.transaction():
+                await new_blog('rolled back').save()
+                raise ValueError
+        except ValueError:
+            pass
+        async with orm.transaction():
+            await new_blog('outer').save()
+            try:
+                async with orm.transaction():
+                    await new_blog('inner').save()
+                    raise ValueError
+            except ValueError:
+                pass
+        names = sorted(b.name for b in await Blog.findAll())
+        assert names == ['committed', 'outer'], names
+        assert await Blog.findNumber('count(id)') == 2
+        print('transactions ok')
+    finally:
+        await orm.close_pool()
+
+# 主键缓存和查询结果缓存：写操作使缓存失效，之后的读不会得到旧数据
+async def test_caches():
+    await sqlite_pool()
+    try:
+        b = new_blog('old')
+        await b.save()
+        assert (await Blog.find(b.id)).name == 'old'
+        assert (await Blog.find(b.id)).name == 'old'    # 第二次读取命中主键缓存
+        assert Blog.cache_stats()['hits'] >= 1
+        b.name = 'new'
+        await b.update()
+        assert (await Blog.find(b.id)).name == 'new'
+        assert len(await Blog.findAll()) == 1
+        assert len(await Blog.findAll()) == 1    # 命中结果缓存
+        assert Blog.query_cache_stats()['hits'] >= 1
+        await new_blog('second').save()
+        assert len(await Blog.findAll()) == 2
+        try:
+            async with orm.transaction():
+                await b.remove()
+                assert await Blog.find(b.id) is None    # 事务中读到自己未提交的修改
+                raise ValueError
+        except ValueError:
+            pass
+        assert (await Blog.find(b.id)).name == 'new'    # 回滚后缓存中不是事务中的数据
+        assert len(await Blog.findAll()) == 2
+        print('caches ok')
+    finally:
+        await orm.close_pool()
+
+# 键集分页：after/before翻页，CursorPage生成游标
+async def test_keyset_pagination():
+    await sqlite_pool()
+    try:
+        await Blog.save_many([new_blog('b%d' % i, created_at=i) for i in range(7)])
+        page = CursorPage(page_size=3, keyset=Blog.__keyset__)
+        first = page.paginate(await Blog.findAll(limit=page.limit, **page.seek))
+        assert [b.name for b in first] == ['b6', 'b5', 'b4'] and page.has_next and not page.has_previous
+        page = CursorPage(page.next_cursor, page_size=3, keyset=Blog.__keyset__)
+        second = page.paginate(await Blog.findAll(limit=page.limit, **page.seek))
+        assert [b.name for b in second] == ['b3', 'b2', 'b1'] and page.has_next and page.has_previous
+        page = CursorPage(page.previous_cursor, page_size=3, keyset=Blog.__keyset__)
+        back = page.paginate(await Blog.findAll(limit=page.limit, **page.seek))
+        assert [b.name for b in back] == ['b6', 'b5', 'b4'], [b.name for b in back]
+        last = await Blog.findAll(after=second[-1].keyset(), limit=3)
+        assert [b.name for b in last] == ['b0']
+        print('keyset pagination ok')
+    finally:
+        await orm.close_pool()
+
+# 部分UPDATE：只更新加载之后修改过的列
+async def test_partial_update():
+    await sqlite_pool()
+    try:
+        b = new_blog('b')
+        await b.save()
+        b = await Blog.find(b.id)
+        assert b.dirty_fields() == []
+        b.name = 'renamed'
+        b.summary = 's'    # 赋相同的值不算修改
+        assert b.dirty_fields() == ['name']
+        await b.update()
+        assert 'update `blogs` set `name` = ? where `id`=?' in [s['sql'] for s in orm.statement_stats()]
+        assert (await Blog.find(b.id)).name == 'renamed'
+        print('partial update ok')
+    finally:
+        await orm.close_pool()
+
+# 合并的读：每个调用者只受自己的timeout限制，短timeout的调用者超时不会终止其他调用者共享的查询
+SLOW_SELECT = 'with recursive c(x) as (select 1 union all select x+1 from c where x<?) select count(*) n from c'
+
+async def test_coalesced_timeouts():
+    await orm.create_pool(None, backend='sqlite', path=':memory:', coalesce_reads=True)
+    try:
+        start = time.monotonic()
+        short = orm.select(SLOW_SELECT, [3000000], timeout=0.05)
+        long = orm.select(SLOW_SELECT, [3000000], timeout=10)
+        r1, r2 = await asyncio.gather(short, long, return_exceptions=True)
+        assert isinstance(r1, orm.QueryTimeoutError), r1
+        assert r2 == [{'n': 3000000}], r2
+        assert orm.get_statement(SLOW_SELECT).coalesced == 1
+        print('coalesced timeouts ok (%.2fs)' % (time.monotonic() - start))
+    finally:
+        await orm.close_pool()
 
 loop = asyncio.get_event_loop()
+loop.run_until_complete(test_coalesced_timeouts())
+loop.run_until_complete(test_transactions())
+loop.run_until_complete(test_caches())
+loop.run_until_complete(test_keyset_pagination())
+loop.run_until_complete(test_partial_update())
 loop.run_until_complete(test(loop))
 loop.close()